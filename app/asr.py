@@ -0,0 +1,162 @@
+"""Speech recognition backends: the engines that load whisper models & run them on decoded audio
+
+Every backend takes the app's whisper settings (as converted by `core._whisper_decode_args`) & returns transcripts
+in the format of `whisper.transcribe`: a dict with the text, the language & a list of segment dicts with id, seek,
+start, end, text, temperature, avg_logprob, compression_ratio & no_speech_prob.
+"""
+import itertools
+from pathlib import Path
+from typing import Any, Dict, Iterator, NamedTuple, Tuple
+
+import numpy as np
+import torch
+import whisper
+
+# Backend used when the settings don't name one
+DEFAULT_ASR_BACKEND = "whisper"
+
+
+class ASRBackend:
+    "Interface of a speech recognition engine"
+
+    def load(self, whisper_model: str, device: str, quantize: bool):
+        "Load a model (downloading it if needed), with int8 weights if `quantize` is set (only on CPU)"
+        raise NotImplementedError
+
+    def model_size(self, model) -> int:
+        "Memory used by the model (in bytes)"
+        raise NotImplementedError
+
+    def stream(self, model, audio: np.ndarray, **whisper_args) -> Tuple[str, Iterator[dict]]:
+        "Detected language & an iterator over the segments of the audio, decoded as they are consumed"
+        raise NotImplementedError
+
+    def transcribe(self, model, audio: np.ndarray, **whisper_args) -> dict:
+        "Transcribe all of the audio"
+        language, segments = self.stream(model, audio, **whisper_args)
+        segments = list(segments)
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments, "language": language}
+
+
+class WhisperBackend(ASRBackend):
+    "The reference openai-whisper implementation (PyTorch), on CPU or GPU"
+
+    def load(self, whisper_model: str, device: str, quantize: bool):
+        model = whisper.load_model(whisper_model, device=device)
+        if quantize:
+            model = quantize_model(model)
+        return model
+
+    def model_size(self, model) -> int:
+        tensors = itertools.chain(model.parameters(), model.buffers(), quantized_weights(model))
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def stream(self, model, audio: np.ndarray, **whisper_args) -> Tuple[str, Iterator[dict]]:
+        # NOTE: whisper only returns segments once the whole audio is decoded
+        transcript = self.transcribe(model, audio, **whisper_args)
+        return transcript["language"], iter(transcript["segments"])
+
+    def transcribe(self, model, audio: np.ndarray, **whisper_args) -> dict:
+        whisper_args.setdefault("fp16", model.device.type == "cuda")
+        return model.transcribe(audio, **whisper_args)
+
+
+def quantize_model(model):
+    """Quantize the weights of the linear layers of a whisper model to int8 for faster CPU inference
+
+    Uses dynamic quantization: weights are stored as int8 & activations are quantized on the fly, so no calibration
+    is needed. Embeddings, convolutions & layer norms stay in full precision.
+    """
+    # Whisper's Linear only overrides `forward` to cast the weights to the input's dtype, which is a no-op on CPU.
+    # Dynamic quantization only replaces plain Linear layers, so turn them back into those first
+    for module in model.modules():
+        if type(module) is whisper.model.Linear:
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_weights(model) -> Iterator[torch.Tensor]:
+    "Weights & biases of the layers quantized by `quantize_model`, which are packed & so aren't parameters or buffers"
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            yield module.weight()
+            if module.bias() is not None:
+                yield module.bias()
+
+
+# Bytes per weight of the CTranslate2 compute types
+WEIGHT_BYTES = {"float32": 4, "float16": 2, "int8": 1}
+
+
+class FasterWhisperBackend(ASRBackend):
+    """The faster-whisper reimplementation on CTranslate2, which is several times faster than whisper on CPU
+
+    Requires `pip install faster-whisper`. The whisper settings are passed on as the equivalent faster-whisper
+    options. Models are converted versions of the whisper ones (downloaded from the Hugging Face hub) & run with int8
+    weights when quantized, or in float32 (CPU) / float16 (GPU) otherwise.
+    """
+
+    def load(self, whisper_model: str, device: str, quantize: bool):
+        from faster_whisper import WhisperModel
+        from faster_whisper.utils import download_model
+
+        model_path = download_model(whisper_model)
+        compute_type = "int8" if quantize else "float16" if device == "cuda" else "float32"
+        # Use as many threads as torch, which are split between the transcription processes (see `init_transcriber`)
+        model = WhisperModel(model_path, device=device, compute_type=compute_type, cpu_threads=torch.get_num_threads())
+        # CTranslate2 doesn't report the memory a model uses, so estimate it from its weights file, whose float16
+        # weights are converted to the compute type when loaded
+        checkpoint_size = Path(model_path, "model.bin").stat().st_size
+        model.weights_size = checkpoint_size * WEIGHT_BYTES[compute_type] // WEIGHT_BYTES["float16"]
+        return model
+
+    def model_size(self, model) -> int:
+        return model.weights_size
+
+    def stream(self, model, audio: np.ndarray, **whisper_args) -> Tuple[str, Iterator[dict]]:
+        # Options that are named differently, or that don't apply
+        whisper_args["log_prob_threshold"] = whisper_args.pop("logprob_threshold", None)
+        for key in ("verbose", "fp16"):
+            whisper_args.pop(key, None)
+        segments, info = model.transcribe(audio, **whisper_args)
+        return info.language, (
+            {
+                # Number segments from 0, as whisper does
+                "id": i,
+                "seek": segment.seek,
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text,
+                "temperature": segment.temperature,
+                "avg_logprob": segment.avg_logprob,
+                "compression_ratio": segment.compression_ratio,
+                "no_speech_prob": segment.no_speech_prob,
+            }
+            for i, segment in enumerate(segments)
+        )
+
+
+class Transcriber(NamedTuple):
+    "A model loaded by a backend, which transcribes with that backend"
+
+    backend: ASRBackend
+    model: Any
+
+    def stream(self, audio: np.ndarray, **whisper_args) -> Tuple[str, Iterator[dict]]:
+        return self.backend.stream(self.model, audio, **whisper_args)
+
+    def transcribe(self, audio: np.ndarray, **whisper_args) -> dict:
+        return self.backend.transcribe(self.model, audio, **whisper_args)
+
+
+ASR_BACKENDS: Dict[str, ASRBackend] = {
+    "whisper": WhisperBackend(),
+    "faster-whisper": FasterWhisperBackend(),
+}
+
+
+def get_asr_backend(asr_backend: str) -> ASRBackend:
+    "Get a backend by name"
+    if asr_backend not in ASR_BACKENDS:
+        raise ValueError(f"Unknown ASR backend {asr_backend!r}, expected one of {', '.join(ASR_BACKENDS)}")
+    return ASR_BACKENDS[asr_backend]
@@ -0,0 +1,176 @@
+"""Audio helpers: decoding (with a cache) & functions that work on decoded waveforms
+
+Waveforms are 16 kHz mono float32 numpy arrays, as used by whisper.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import whisper
+from config import DECODED_AUDIO_CACHE_MB, DECODED_AUDIO_DIR
+
+# Whisper resamples everything to 16 kHz
+SAMPLE_RATE = 16000
+
+# Name of the cached waveforms that earlier versions kept next to the audio file they were decoded from
+DECODED_AUDIO_FILENAME = "audio.16k.npy"
+
+
+def decoded_audio_path(audio_path: str, cache_dir: Path = DECODED_AUDIO_DIR) -> Path:
+    "Path of the cached waveform of an audio file, named after the file's path & modification time"
+    stat = os.stat(audio_path)
+    key = f"{Path(audio_path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+    return cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.npy"
+
+
+def load_audio(audio_path: str) -> np.ndarray:
+    """Decode the audio file to a waveform, reusing the cached waveform if it was decoded before
+
+    The cached waveform is memory mapped, so only the parts that are used are read from disk.
+    """
+    cache_path = decoded_audio_path(audio_path)
+    try:
+        audio = np.load(cache_path, mmap_mode="r")
+        # Mark the cache file as recently used
+        os.utime(cache_path)
+        return audio
+    except FileNotFoundError:
+        pass
+
+    # Decode with ffmpeg & write to a temporary file first so that other processes never load a partial file
+    audio = whisper.load_audio(audio_path)
+    tmp_path = cache_path.with_name(f".{os.getpid()}.{cache_path.name}")
+    np.save(tmp_path, audio)
+    os.replace(tmp_path, cache_path)
+    evict_decoded_audio(keep=cache_path)
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+def evict_decoded_audio(keep: Path, cache_dir: Path = DECODED_AUDIO_DIR, budget_mb: float = DECODED_AUDIO_CACHE_MB):
+    """Delete the least recently used cached waveforms (other than `keep`) until the cache fits in the disk budget
+
+    Only the cache directory is listed, so this doesn't slow down as the media library grows.
+    """
+    cache_files = []
+    for path in cache_dir.glob("*.npy"):
+        # Skip the files that are being written
+        if path.name.startswith("."):
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        cache_files.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files):
+        if total_size <= budget_mb * 2**20:
+            break
+        if path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total_size -= size
+
+
+def frame_energy(audio: np.ndarray, frame_length: float = 0.03) -> np.ndarray:
+    "Root mean square energy of consecutive, non-overlapping frames of `frame_length` seconds"
+    frame_size = int(frame_length * SAMPLE_RATE)
+    n_frames = len(audio) // frame_size
+    frames = audio[: n_frames * frame_size].reshape(n_frames, frame_size)
+    return np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+
+
+def find_silence_boundaries(
+    audio: np.ndarray, chunk_length: float, search_window: float = 30.0, frame_length: float = 0.03
+) -> List[int]:
+    """Split points (in samples) roughly every `chunk_length` seconds, moved to the quietest frame nearby
+
+    Each split point is placed at the lowest energy frame within `search_window` seconds before the nominal
+    split, so that chunks are cut in pauses rather than mid-word. The first & last points are the audio bounds.
+    """
+    energy = frame_energy(audio, frame_length)
+    frame_size = int(frame_length * SAMPLE_RATE)
+    frames_per_chunk = max(1, int(chunk_length / frame_length))
+    frames_per_window = max(1, int(search_window / frame_length))
+
+    boundaries = [0]
+    position = 0
+    while position + frames_per_chunk < len(energy):
+        nominal = position + frames_per_chunk
+        window_start = max(position + 1, nominal - frames_per_window)
+        quietest = window_start + int(np.argmin(energy[window_start : nominal + 1]))
+        boundaries.append(quietest * frame_size)
+        position = quietest
+    boundaries.append(len(audio))
+
+    return boundaries
+
+
+def overlapping_chunks(boundaries: List[int], overlap: float, n_samples: int) -> List[Tuple[int, int]]:
+    "Chunk ranges (in samples) between consecutive boundaries, extended by `overlap` seconds on both sides"
+    overlap_samples = int(overlap * SAMPLE_RATE)
+    return [
+        (max(0, start - overlap_samples), min(n_samples, end + overlap_samples))
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def speech_regions(
+    audio: np.ndarray,
+    margin_db: float,
+    silence_db: float,
+    min_silence: float,
+    padding: float,
+    frame_length: float = 0.03,
+) -> List[Tuple[int, int]]:
+    """Ranges (in samples) of the audio that contain speech, detected by energy
+
+    Frames are silent if they are quieter than the noise floor (the 10th percentile of frame energy) plus `margin_db`
+    & than `silence_db` dBFS, so that speech over steady noise or music isn't taken for silence. Silences longer than
+    `min_silence` seconds separate regions, which keep `padding` seconds of silence on each side so that words aren't
+    clipped. Returns no regions if the audio is silent throughout.
+
+    The filter fails open: audio that isn't silent but whose loudness varies by less than `margin_db` (e.g. speech
+    over steady noise) is returned whole, as speech can't be told apart from the background.
+    """
+    energy = frame_energy(audio, frame_length)
+    if not len(energy):
+        return []
+    energy_db = 20 * np.log10(np.maximum(energy, 1e-10))
+    noise_floor, loud_level = np.percentile(energy_db, [10, 90])
+    if loud_level - noise_floor < margin_db and loud_level > silence_db:
+        return [(0, len(audio))]
+    loud_frames = np.flatnonzero(energy_db > min(noise_floor + margin_db, silence_db))
+    if not len(loud_frames):
+        return []
+
+    # Split where consecutive loud frames are further apart than the minimum silence
+    gaps = np.flatnonzero(np.diff(loud_frames) * frame_length > min_silence)
+    frame_size = int(frame_length * SAMPLE_RATE)
+    padding_samples = int(padding * SAMPLE_RATE)
+    regions = []
+    for first, last in zip(loud_frames[np.r_[0, gaps + 1]], loud_frames[np.r_[gaps, len(loud_frames) - 1]]):
+        start = max(0, int(first) * frame_size - padding_samples)
+        end = min(len(audio), (int(last) + 1) * frame_size + padding_samples)
+        # Padding can make regions touch
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def original_time(seconds: float, regions: List[Tuple[int, int]], end: bool = False) -> float:
+    """Map a time in the audio made of the given regions only (see `speech_regions`) back to the original audio
+
+    A time at the boundary of two regions is mapped to the end of the first if `end` is set, or else to the start
+    of the second.
+    """
+    offsets = np.cumsum([0] + [region_end - region_start for region_start, region_end in regions])
+    sample = seconds * SAMPLE_RATE
+    i = int(np.clip(np.searchsorted(offsets, sample, side="left" if end else "right") - 1, 0, len(regions) - 1))
+    region_start, region_end = regions[i]
+    return float(min(region_start + sample - offsets[i], region_end)) / SAMPLE_RATE
@@ -1,4 +1,5 @@
 import json
+import os
 import pathlib
 
 # Project structure
@@ -6,9 +7,9 @@ import pathlib
 APP_DIR = pathlib.Path(__file__).parent.absolute()
 PROJECT_DIR = APP_DIR.parent.absolute()
 
-# Create a data directory to save all local data files
-DATA_DIR = PROJECT_DIR / "data"
-DATA_DIR.mkdir(exist_ok=True)
+# Create a data directory to save all local data files (can be moved elsewhere, e.g. to benchmark with a clean one)
+DATA_DIR = pathlib.Path(os.environ.get("BABYJARVIS_DATA_DIR", PROJECT_DIR / "data"))
+DATA_DIR.mkdir(exist_ok=True, parents=True)
 
 # Create a data directory
 MEDIA_DIR = DATA_DIR / "media"
@@ -16,6 +17,37 @@ MEDIA_DIR.mkdir(exist_ok=True)
 
 DEBUG = False
 
+# Decoded (16 kHz) audio is cached in a directory of its own to skip decoding when media is transcribed again. The
+# least recently used files are deleted when the cache grows past this size
+DECODED_AUDIO_DIR = DATA_DIR / "decoded"
+DECODED_AUDIO_DIR.mkdir(exist_ok=True)
+DECODED_AUDIO_CACHE_MB = 20480
+
+# Files of deleted media are removed in the background, every this many seconds
+TRASH_COLLECT_INTERVAL = 10.0
+
+# Create a directory for the segment embeddings used by semantic search
+VECTOR_DIR = DATA_DIR / "vectors"
+VECTOR_DIR.mkdir(exist_ok=True)
+
+# Sentence embedding model used for semantic search (runs locally)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Uploads
+# -------
+# Uploads are copied to the media directory in chunks of this size (in bytes) & rejected above the size limit
+UPLOAD_CHUNK_SIZE = 2**20
+MAX_UPLOAD_SIZE_MB = 4096
+
+# Storage
+# -------
+# How downloaded & uploaded media is stored: "original" keeps the files as they are, while "opus" extracts the audio
+# track & transcodes it to Opus at this bitrate when a job downloads it, which is all that is used for transcription
+# & playback. The original is then deleted unless KEEP_ORIGINAL_MEDIA is set
+STORAGE_POLICY = "original"
+OPUS_BITRATE = "32k"
+KEEP_ORIGINAL_MEDIA = False
+
 
 # Whisper config
 # --------------
@@ -30,9 +62,40 @@ WHISPER_DEFAULT_SETTINGS = {
     "condition_on_previous_text": True,
     "verbose": False,
     "task": "transcribe",
+    # Long file mode: files longer than the threshold (in seconds) are split at pauses into overlapping chunks
+    # which are transcribed in parallel processes
+    "long_file_threshold": 1800.0,
+    "chunk_length": 600.0,
+    "chunk_overlap": 5.0,
+    "chunk_workers": 4,
+    # Quantize the linear layers of the model to int8 when running on CPU: faster & smaller, at a small cost in accuracy
+    # (see benchmarks/bench_quantization.py)
+    "quantize": False,
+    # Engine that runs the model: "whisper" (openai-whisper) or "faster-whisper" (CTranslate2, faster on CPU & needs
+    # `pip install faster-whisper`), see app/asr.py
+    "asr_backend": "whisper",
+    # Skip the silences in the audio (see VAD_* below) instead of transcribing them
+    "vad_filter": False,
 }
 WHISPER_SETTINGS_FILE = DATA_DIR / ".whisper_settings.json"
 
+# Loaded models are kept in memory (per transcription process) until their combined size exceeds this budget,
+# after which the least recently used ones are unloaded
+WHISPER_MODEL_MEMORY_BUDGET_MB = 4096
+# Models that workers load & warm up when they start, e.g. ["base", "small"]
+WHISPER_PRELOAD_MODELS = []
+# Jobs transcribe files in windows of about this many seconds (cut at pauses) & save the segments of each window
+# as soon as it is decoded, so that an interrupted job resumes from the last window instead of from the start & the
+# transcript can be followed live from the Whisper page
+TRANSCRIBE_CHECKPOINT_INTERVAL = 60.0
+# Voice activity filter: frames more than VAD_MARGIN_DB louder than the noise floor or louder than VAD_SILENCE_DB
+# (dBFS) are speech, & silences longer than VAD_MIN_SILENCE seconds between them are cut out before transcription,
+# keeping VAD_PADDING seconds on each side
+VAD_MARGIN_DB = 10.0
+VAD_SILENCE_DB = -50.0
+VAD_MIN_SILENCE = 1.0
+VAD_PADDING = 0.2
+
 
 def save_whisper_settings(settings):
     with open(WHISPER_SETTINGS_FILE, "w") as f:
@@ -1,26 +1,750 @@
 """Thin wrapper class to manage Media objects."""
+import hashlib
+import json
+import multiprocessing
+import os
 import shutil
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from functools import lru_cache
 from pathlib import Path
-from typing import Any, List, Union
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import ffmpeg
 import numpy as np
+import torch
 import whisper
-from config import MEDIA_DIR
-from db import ENGINE, Media, Segment, Transcript
+from asr import DEFAULT_ASR_BACKEND, Transcriber, WhisperBackend, get_asr_backend
+from audio import (
+    DECODED_AUDIO_FILENAME,
+    SAMPLE_RATE,
+    find_silence_boundaries,
+    load_audio,
+    original_time,
+    overlapping_chunks,
+    speech_regions,
+)
+from config import (
+    KEEP_ORIGINAL_MEDIA,
+    MAX_UPLOAD_SIZE_MB,
+    MEDIA_DIR,
+    OPUS_BITRATE,
+    STORAGE_POLICY,
+    TRANSCRIBE_CHECKPOINT_INTERVAL,
+    TRASH_COLLECT_INTERVAL,
+    UPLOAD_CHUNK_SIZE,
+    VAD_MARGIN_DB,
+    VAD_MIN_SILENCE,
+    VAD_PADDING,
+    VAD_SILENCE_DB,
+    WHISPER_MODEL_MEMORY_BUDGET_MB,
+    get_whisper_settings,
+)
+from db import (
+    ENGINE,
+    Blob,
+    Job,
+    Media,
+    Segment,
+    Transcript,
+    TranscriptionMetric,
+    Trash,
+    segment_fts,
+    timestamp,
+    transcript_fts,
+)
 from pytube import Playlist, YouTube
+from sqlalchemy import and_, delete, func, insert, literal_column, null, or_, select, text, tuple_, update
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
+from vectors import SEGMENT_INDEX
 
 
 # Whisper transcription functions
 # ----------------
-@lru_cache(maxsize=1)
-def get_whisper_model(whisper_model: str):
-    """Get a whisper model from the cache or download it if it doesn't exist"""
-    model = whisper.load_model(whisper_model)
-    return model
+class WhisperModelPool:
+    """Thread-safe cache of loaded whisper models, keyed by backend (see asr.py), model name, device & quantization
+
+    Models are evicted least recently used first once their combined size exceeds the memory budget. A model that
+    is larger than the budget on its own is still loaded, but evicts everything else.
+    """
+
+    def __init__(self, memory_budget_mb: float):
+        self.memory_budget = memory_budget_mb * 2**20
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def default_device() -> str:
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    def get(
+        self,
+        whisper_model: str,
+        device: Optional[str] = None,
+        quantize: bool = False,
+        asr_backend: str = DEFAULT_ASR_BACKEND,
+    ) -> Transcriber:
+        """Get a model from the pool, loading it (& downloading it if it doesn't exist) if needed
+
+        Quantized models (see `asr.quantize_model`) are only used on CPU & are cached separately from the full
+        precision ones, so that each is quantized once.
+        """
+        device = device or self.default_device()
+        key = (asr_backend, whisper_model, device, quantize and device == "cpu")
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+            backend = get_asr_backend(asr_backend)
+            model = backend.load(whisper_model, device, key[3])
+            size = backend.model_size(model)
+            # Evict the least recently used models until the new one fits
+            while self.models and sum(size for _, size in self.models.values()) + size > self.memory_budget:
+                self.models.popitem(last=False)
+            self.models[key] = (Transcriber(backend, model), size)
+            return self.models[key][0]
+
+    def preload(
+        self,
+        whisper_models: List[str],
+        warmup: bool = True,
+        quantize: bool = False,
+        asr_backend: str = DEFAULT_ASR_BACKEND,
+    ):
+        "Load models ahead of time & optionally run them once on a second of silence so that the first job is fast"
+        for whisper_model in whisper_models:
+            transcriber = self.get(whisper_model, quantize=quantize, asr_backend=asr_backend)
+            if warmup:
+                transcriber.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32))
+
+
+MODEL_POOL = WhisperModelPool(WHISPER_MODEL_MEMORY_BUDGET_MB)
+
+
+def get_whisper_model(
+    whisper_model: str, quantize: bool = False, asr_backend: str = DEFAULT_ASR_BACKEND
+) -> Transcriber:
+    """Get a whisper model, loaded by the given backend, from the pool or download it if it doesn't exist"""
+    return MODEL_POOL.get(whisper_model, quantize=quantize, asr_backend=asr_backend)
+
+
+def init_transcriber(num_threads: int, preload_models: Tuple[str, ...] = ()):
+    """Set up a transcription process
+
+    Splits the CPU cores between transcription processes (instead of letting each of them use all of them) &
+    loads the given whisper models, with the backend & quantization of the saved settings, ahead of the first job.
+    """
+    torch.set_num_threads(num_threads)
+    whisper_settings = get_whisper_settings()
+    MODEL_POOL.preload(
+        list(preload_models),
+        quantize=whisper_settings["quantize"],
+        asr_backend=whisper_settings["asr_backend"],
+    )
+
+
+def _whisper_decode_args(whisper_args: dict) -> dict:
+    "Convert the app's whisper settings to the arguments expected by `whisper.transcribe`"
+    whisper_args = dict(whisper_args)
+    if whisper_args["temperature_increment_on_fallback"] is not None:
+        whisper_args["temperature"] = tuple(
+            np.arange(whisper_args["temperature"], 1.0 + 1e-6, whisper_args["temperature_increment_on_fallback"])
+        )
+    else:
+        whisper_args["temperature"] = [whisper_args["temperature"]]
+
+    del whisper_args["temperature_increment_on_fallback"]
+    return whisper_args
+
+
+def transcribe_speech(transcriber: Transcriber, audio: np.ndarray, vad_filter: bool = False, **whisper_args) -> dict:
+    """Transcribe the audio, leaving out its silences (see `audio.speech_regions`) if `vad_filter` is set
+
+    Only the speech is passed to the model & the timestamps of the transcript are mapped back to the audio. The
+    transcript's `skipped_duration` is the length of audio (in seconds) that wasn't transcribed & its `speech_regions`
+    are the ranges (in samples) that were.
+    """
+    if not vad_filter:
+        return {**transcriber.transcribe(audio, **whisper_args), "skipped_duration": 0.0}
+
+    regions = speech_regions(audio, VAD_MARGIN_DB, VAD_SILENCE_DB, VAD_MIN_SILENCE, VAD_PADDING)
+    skipped_duration = (len(audio) - sum(end - start for start, end in regions)) / SAMPLE_RATE
+    if not regions:
+        return {"text": "", "segments": [], "language": "", "skipped_duration": skipped_duration, "speech_regions": []}
+
+    transcript = transcriber.transcribe(np.concatenate([audio[start:end] for start, end in regions]), **whisper_args)
+    for segment in transcript["segments"]:
+        segment["start"] = original_time(segment["start"], regions)
+        segment["end"] = original_time(segment["end"], regions, end=True)
+        # Seek is counted in mel frames (10ms each)
+        segment["seek"] = int(original_time(segment["seek"] / 100, regions) * 100)
+    return {**transcript, "skipped_duration": skipped_duration, "speech_regions": regions}
+
+
+def _transcribe_chunk(
+    audio_path: str,
+    start: int,
+    end: int,
+    whisper_model: str,
+    whisper_args: dict,
+    checkpoint_path: Optional[Path] = None,
+    quantize: bool = False,
+    asr_backend: str = DEFAULT_ASR_BACKEND,
+    vad_filter: bool = False,
+):
+    """Transcribe the samples from start to end of the (cached) decoded audio file (runs in a chunk worker process)
+
+    If a checkpoint path is given, the transcript is saved there & reused if the chunk was transcribed before.
+    """
+    if checkpoint_path is not None and checkpoint_path.exists():
+        return json.loads(checkpoint_path.read_text())
+
+    audio = np.array(load_audio(audio_path)[start:end])
+    transcriber = get_whisper_model(whisper_model, quantize, asr_backend)
+    transcript = transcribe_speech(transcriber, audio, vad_filter, **whisper_args)
+    # Chunk processes are started for each file, so this is the peak of transcribing it
+    transcript["peak_rss_mb"] = peak_rss_mb()
+
+    if checkpoint_path is not None:
+        # Write to a temporary file first so that an interrupted write is never taken for a finished chunk
+        tmp_path = checkpoint_path.with_name(f".{checkpoint_path.name}")
+        tmp_path.write_text(json.dumps(transcript))
+        os.replace(tmp_path, checkpoint_path)
+    return transcript
+
+
+def stitch_chunks(transcripts: List[dict], chunks: List[Tuple[int, int]], boundaries: List[int]) -> dict:
+    """Merge the transcripts of overlapping chunks into a single transcript
+
+    Segment timestamps are shifted by the chunk offset and only segments whose midpoint falls between the chunk's
+    own (silence) boundaries are kept, so that speech in the overlap appears exactly once. Segment ids are
+    renumbered to run across the whole file. Likewise, silence skipped by the voice activity filter only counts
+    between the chunk's own boundaries.
+    """
+    segments = []
+    skipped_duration = 0.0
+    for transcript, (chunk_start, _), keep_start, keep_end in zip(transcripts, chunks, boundaries[:-1], boundaries[1:]):
+        if "speech_regions" in transcript:
+            speech = sum(
+                max(0, min(chunk_start + end, keep_end) - max(chunk_start + start, keep_start))
+                for start, end in transcript["speech_regions"]
+            )
+            skipped_duration += (keep_end - keep_start - speech) / SAMPLE_RATE
+        else:
+            # Transcribed without the filter (or checkpointed before its regions were recorded)
+            skipped_duration += transcript.get("skipped_duration", 0.0)
+
+        offset = chunk_start / SAMPLE_RATE
+        for segment in transcript["segments"]:
+            start, end = segment["start"] + offset, segment["end"] + offset
+            midpoint = (start + end) / 2
+            if not keep_start / SAMPLE_RATE <= midpoint < keep_end / SAMPLE_RATE:
+                continue
+            segments.append(
+                {
+                    **segment,
+                    "id": len(segments),
+                    # Seek is counted in mel frames (10ms each)
+                    "seek": segment["seek"] + int(offset * 100),
+                    "start": start,
+                    "end": end,
+                }
+            )
+
+    # Chunks that were silent throughout have no language
+    languages = [transcript["language"] for transcript in transcripts if transcript["language"]] or [""]
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": max(set(languages), key=languages.count),
+        "skipped_duration": skipped_duration,
+    }
+
+
+def transcribe_long(
+    audio_path: str,
+    whisper_model: str,
+    chunk_length: float,
+    chunk_overlap: float,
+    chunk_workers: int,
+    checkpoint_dir: Optional[Path] = None,
+    quantize: bool = False,
+    asr_backend: str = DEFAULT_ASR_BACKEND,
+    vad_filter: bool = False,
+    **whisper_args,
+):
+    """Transcribe a long audio file by splitting it at pauses & transcribing the chunks in parallel processes
+
+    If a checkpoint directory is given, the transcript of each chunk is saved there as it finishes so that an
+    interrupted run only transcribes the chunks that weren't done. The transcript's `peak_rss_mb` is the largest peak
+    memory of the chunk processes.
+    """
+    audio = load_audio(audio_path)
+    boundaries = find_silence_boundaries(audio, chunk_length)
+    chunks = overlapping_chunks(boundaries, chunk_overlap, len(audio))
+    if checkpoint_dir is not None:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint_paths = [checkpoint_dir / f"chunk-{start}-{end}.json" for start, end in chunks]
+    else:
+        checkpoint_paths = [None] * len(chunks)
+
+    with ProcessPoolExecutor(
+        max_workers=min(chunk_workers, len(chunks)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_transcriber,
+        initargs=(max(1, os.cpu_count() // chunk_workers),),
+    ) as pool:
+        transcripts = list(
+            pool.map(
+                _transcribe_chunk,
+                [audio_path] * len(chunks),
+                [start for start, _ in chunks],
+                [end for _, end in chunks],
+                [whisper_model] * len(chunks),
+                [whisper_args] * len(chunks),
+                checkpoint_paths,
+                [quantize] * len(chunks),
+                [asr_backend] * len(chunks),
+                [vad_filter] * len(chunks),
+            )
+        )
+
+    peak_rss = max(transcript.get("peak_rss_mb", 0.0) for transcript in transcripts)
+    return {**stitch_chunks(transcripts, chunks, boundaries), "peak_rss_mb": peak_rss}
+
+
+def use_long_file_mode(n_samples: int, long_file_threshold: Optional[float], chunk_workers: int) -> bool:
+    "Whether audio of this length is transcribed in parallel chunks (if the long file mode is enabled & worth it)"
+    return bool(long_file_threshold) and chunk_workers > 1 and n_samples / SAMPLE_RATE > long_file_threshold
+
+
+def transcribe_windows(
+    audio_path: str,
+    whisper_model: str,
+    window_length: float,
+    start: float = 0.0,
+    quantize: bool = False,
+    asr_backend: str = DEFAULT_ASR_BACKEND,
+    vad_filter: bool = False,
+    **whisper_args,
+) -> Iterator[Tuple[float, dict]]:
+    """Transcribe the audio file from `start` seconds on, one window of about `window_length` seconds at a time
+
+    Windows are cut at pauses (see `find_silence_boundaries`). Yields the end of each window (in seconds) along with
+    its transcript, whose timestamps are relative to the start of the file. The text of each window is used as the
+    prompt of the next one when `condition_on_previous_text` is set, as whisper does between its 30 second windows.
+    """
+    whisper_args = _whisper_decode_args(whisper_args)
+    audio = load_audio(audio_path)
+    transcriber = get_whisper_model(whisper_model, quantize, asr_backend)
+
+    start_sample = int(start * SAMPLE_RATE)
+    boundaries = [start_sample + boundary for boundary in find_silence_boundaries(audio[start_sample:], window_length)]
+    prompt = whisper_args.pop("initial_prompt", None)
+    for window_start, window_end in zip(boundaries[:-1], boundaries[1:]):
+        window_audio = np.array(audio[window_start:window_end])
+        transcript = transcribe_speech(transcriber, window_audio, vad_filter, initial_prompt=prompt, **whisper_args)
+        offset = window_start / SAMPLE_RATE
+        for segment in transcript["segments"]:
+            segment["start"] += offset
+            segment["end"] += offset
+            # Seek is counted in mel frames (10ms each)
+            segment["seek"] += int(offset * 100)
+        if whisper_args.get("condition_on_previous_text", True):
+            prompt = transcript["text"]
+
+        yield window_end / SAMPLE_RATE, transcript
+
+
+# Clips that fit in a single whisper window can be decoded together in one batch
+BATCH_MAX_DURATION = float(whisper.audio.CHUNK_LENGTH)
+
+
+def _batch_segments(tokenizer, tokens: List[int], duration: float) -> List[Tuple[float, float, str]]:
+    "Split the tokens decoded for a clip into (start, end, text) segments at their timestamp tokens"
+    segments = []
+    start = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            # Timestamp tokens count in steps of 20ms
+            seconds = (token - tokenizer.timestamp_begin) * 0.02
+            if text_tokens:
+                segments.append((start, min(seconds, duration), tokenizer.decode(text_tokens)))
+                text_tokens = []
+            start = seconds
+        else:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append((start, duration, tokenizer.decode(text_tokens)))
+    return segments
+
+
+def transcribe_batch(
+    audios: List[np.ndarray],
+    whisper_model: str,
+    quantize: bool = False,
+    asr_backend: str = DEFAULT_ASR_BACKEND,
+    **whisper_args,
+) -> List[dict]:
+    """Transcribe short clips (up to `BATCH_MAX_DURATION` seconds each) with one batched forward pass
+
+    The clips are padded to a whisper window, stacked into a single mel batch & decoded together at the first
+    temperature, instead of running the encoder & decoder once per clip. Clips whose result fails the compression
+    ratio or log probability thresholds are transcribed again on their own with whisper's temperature fallback.
+    Returns a transcript per clip, in the format of `whisper.transcribe`.
+
+    Batching relies on whisper's decoder, so clips are transcribed one at a time with other backends.
+    """
+    decode_args = _whisper_decode_args(whisper_args)
+    transcriber = get_whisper_model(whisper_model, quantize, asr_backend)
+    if not isinstance(transcriber.backend, WhisperBackend):
+        return [transcriber.transcribe(audio, **decode_args) for audio in audios]
+
+    model = transcriber.model
+    mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels) for audio in audios])
+    options = whisper.DecodingOptions(
+        task=decode_args["task"], temperature=decode_args["temperature"][0], fp16=model.device.type == "cuda"
+    )
+    results = whisper.decode(model, mel.to(model.device), options)
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual, num_languages=model.num_languages, task=decode_args["task"]
+    )
+
+    transcripts = []
+    for audio, result in zip(audios, results):
+        # As in whisper's transcribe: likely silent clips never fall back, & are skipped unless decoded confidently
+        no_speech_threshold, logprob_threshold = decode_args["no_speech_threshold"], decode_args["logprob_threshold"]
+        over_no_speech = no_speech_threshold is not None and result.no_speech_prob > no_speech_threshold
+        no_speech = over_no_speech and (logprob_threshold is None or result.avg_logprob <= logprob_threshold)
+        needs_fallback = not over_no_speech and (
+            (
+                decode_args["compression_ratio_threshold"] is not None
+                and result.compression_ratio > decode_args["compression_ratio_threshold"]
+            )
+            or (logprob_threshold is not None and result.avg_logprob < logprob_threshold)
+        )
+        if needs_fallback and len(decode_args["temperature"]) > 1:
+            transcripts.append(transcriber.transcribe(audio, **decode_args))
+            continue
+
+        clip_segments = [] if no_speech else _batch_segments(tokenizer, result.tokens, len(audio) / SAMPLE_RATE)
+        segments = [
+            {
+                "id": i,
+                "seek": 0,
+                "start": start,
+                "end": end,
+                "text": segment_text,
+                "temperature": result.temperature,
+                "avg_logprob": result.avg_logprob,
+                "compression_ratio": result.compression_ratio,
+                "no_speech_prob": result.no_speech_prob,
+            }
+            for i, (start, end, segment_text) in enumerate(clip_segments)
+        ]
+        transcript_text = "".join(segment["text"] for segment in segments)
+        transcripts.append({"text": transcript_text, "segments": segments, "language": result.language})
+
+    return transcripts
+
+
+def job_checkpoint_dir(files_dir: Path, job_id: str) -> Path:
+    "Directory (among the files of its media object) where a job saves the transcripts of the chunks of a long file"
+    return files_dir / "checkpoints" / job_id
+
+
+# Full-text search functions
+# --------------------------
+def fts_query(search: str) -> str:
+    "Quote each word of a search so that it is matched as is instead of being parsed as FTS5 query syntax"
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in search.split())
+
+
+def fts_snippet(fts: str, tokens: int = 24):
+    "Excerpt of the matched text with the matching words wrapped in <mark> tags"
+    return literal_column(f"snippet({fts}, 0, '<mark>', '</mark>', '…', {tokens})")
+
+
+# Media download functions
+# ------------------------
+class HashingWriter:
+    "File-like wrapper that hashes everything written through it, so files are hashed in the same pass"
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def download_source(
+    source_type: str, source: str, source_name: Optional[str], audio_hash: Optional[str], media_dir: Path
+) -> Tuple[str, Path, str, Optional[int]]:
+    """Download the source (if needed) into a staging directory & apply the storage policy to it
+
+    Returns its name, the path of the staged file, the content hash & the size of the original file. The file is moved
+    to the directory of its blob when the media object is created (see `MediaManager._store_blob`). This does not
+    touch the database so that it can run in a download thread.
+    """
+    source_name, filepath, audio_hash = _download_source(source_type, source, source_name, audio_hash, media_dir)
+    original_size = filepath.stat().st_size if filepath.exists() else None
+    # Identical audio that is stored already is reused, so there is no need to transcode it again. This is only a
+    # hint, the policy is applied when the file is stored if that audio has been removed in the meantime
+    if not blob_dir(media_dir, audio_hash).exists():
+        filepath = store_audio(filepath)
+    return source_name, filepath, audio_hash, original_size
+
+
+def _download_source(
+    source_type: str, source: str, source_name: Optional[str], audio_hash: Optional[str], media_dir: Path
+) -> Tuple[str, Path, str]:
+    "Download or stage the source as is & return its name, the path of the staged file & the content hash"
+    # If it is a youtube file, download it with pytube
+    if source_type == "youtube":
+        yc = YouTube(source)
+        source_name = yc.title
+        # itag = 140 is the audio only version
+        save_dir = staging_dir(media_dir)
+        save_filename = "audio.mp4"
+        # Download & hash the audio file
+        with open(save_dir / save_filename, "wb") as f:
+            writer = HashingWriter(f)
+            yc.streams.get_by_itag(140).stream_to_buffer(writer)
+        return source_name, save_dir / save_filename, writer.hexdigest()
+
+    # Uploads are saved (& hashed) to the media directory when they are queued
+    return source_name, Path(source), audio_hash
+
+
+# Content-addressed storage
+# -------------------------
+# Downloads & uploads are saved to a staging directory of their own until they are hashed, & then moved to the
+# directory of their blob (see `db.Blob` & `MediaManager._store_blob`), which is shared by identical media
+def staging_dir(media_dir: Path) -> Path:
+    "Create a new directory to save a download or upload to until it is stored"
+    save_dir = media_dir / "staging" / str(uuid.uuid4())
+    save_dir.mkdir(parents=True)
+    return save_dir
+
+
+def is_staged(media_dir: Path, filepath: Union[str, Path]) -> bool:
+    "Whether the file is in a staging directory (rather than e.g. the directory of a blob)"
+    return Path(filepath).parent.parent == media_dir / "staging"
+
+
+def blob_dir(media_dir: Path, audio_hash: str) -> Path:
+    "Directory of the audio with the given hash, sharded by its first characters so that no directory grows too large"
+    return media_dir / "blobs" / audio_hash[:2] / audio_hash[2:4] / audio_hash
+
+
+def blob_file(save_dir: Path) -> Optional[Path]:
+    "The stored audio file in a blob directory (the transcoded one when the original is kept as well), if any"
+    paths = sorted(
+        (path for path in save_dir.glob("audio.*") if path.name != DECODED_AUDIO_FILENAME),
+        key=lambda path: path.name != OPUS_FILENAME,
+    )
+    return paths[0] if paths else None
+
+
+# Name of the audio file transcoded by the "opus" storage policy, next to the original one
+OPUS_FILENAME = "audio.opus"
+
+
+def store_audio(filepath: Path, policy: str = STORAGE_POLICY, keep_original: bool = KEEP_ORIGINAL_MEDIA) -> Path:
+    """Apply the storage policy to a downloaded file & return the path of the file to use from then on
+
+    With the "opus" policy, the audio track is transcoded to mono Opus next to the file, which is deleted unless
+    `keep_original` is set. A file transcoded before (e.g. by a job that failed & is retried) is reused.
+    """
+    if policy == "original" or filepath.name == OPUS_FILENAME:
+        return filepath
+    if policy != "opus":
+        raise ValueError(f"Unknown storage policy {policy}, use original or opus")
+
+    opus_path = filepath.with_name(OPUS_FILENAME)
+    if not opus_path.exists():
+        # Write to a temporary file first so that an interrupted transcoding is never taken for a finished one
+        tmp_path = filepath.with_name(f".{OPUS_FILENAME}")
+        (
+            ffmpeg.input(str(filepath))
+            .output(str(tmp_path), format="opus", acodec="libopus", audio_bitrate=OPUS_BITRATE, ac=1, vn=None)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        os.replace(tmp_path, opus_path)
+    if not keep_original:
+        filepath.unlink(missing_ok=True)
+    return opus_path
+
+
+def stored_size(filepath: Union[str, Path]) -> int:
+    "Bytes used on disk by the media files in the directory of a media object's file (not exports or caches)"
+    return sum(
+        path.stat().st_size for path in Path(filepath).parent.glob("audio.*") if path.name != DECODED_AUDIO_FILENAME
+    )
+
+
+def probe_duration(filepath: Union[str, Path]) -> Optional[float]:
+    "Duration (in seconds) of a media file read from its container with ffprobe, without decoding the audio"
+    try:
+        return float(ffmpeg.probe(str(filepath))["format"]["duration"])
+    except (ffmpeg.Error, KeyError, ValueError):
+        # Some formats (e.g. raw streams) don't record their duration, it is then set once the audio is decoded
+        return None
+
+
+def reset_peak_rss():
+    "Measure the peak resident memory of this process (see `peak_rss_mb`) from its current use (on Linux)"
+    try:
+        # Writing 5 resets the peak resident set size of the process
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory (in MB) of this process since it started, or since `reset_peak_rss` was last called
+
+    Transcription processes are reused, so each job resets the peak when it starts to measure its own. Returns 0
+    where it can't be measured (on Windows).
+    """
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            # NOTE: VmHWM is in kilobytes
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        # Unix only
+        import resource
+    except ImportError:
+        return 0.0
+    # NOTE: On Linux, ru_maxrss is in kilobytes. It is the peak since the process started
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def pid_exists(pid: int) -> bool:
+    "Whether a process with the given id is running, without signalling it"
+    if os.name == "nt":
+        # os.kill terminates the process on Windows, so ask for its exit code instead
+        import ctypes
+
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # The process exists, but belongs to another user
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        exit_code = ctypes.c_ulong()
+        try:
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        pass
+    return True
+
+
+# Windows API constants used by `pid_exists`
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+ERROR_ACCESS_DENIED = 5
+STILL_ACTIVE = 259
+
+
+# Defaults of the settings that were added after transcripts started being reused by settings hash
+SETTINGS_HASH_DEFAULTS = {"quantize": False, "asr_backend": DEFAULT_ASR_BACKEND, "vad_filter": False}
+
+
+def get_settings_hash(whisper_model: str, whisper_args: dict) -> str:
+    "Hash of the model & the whisper settings that affect the transcript (i.e. not display or parallelism settings)"
+    decoding_args = {key: value for key, value in whisper_args.items() if key not in ("verbose", "chunk_workers")}
+    decoding_args["whisper_model"] = whisper_model
+    # Settings added later are left out at their default, so transcripts made before they existed keep matching
+    for key, default in SETTINGS_HASH_DEFAULTS.items():
+        if decoding_args.get(key, default) == default:
+            decoding_args.pop(key, None)
+    return hashlib.sha256(json.dumps(decoding_args, sort_keys=True).encode()).hexdigest()
+
+
+def timed(func: Callable, *args, **kwargs) -> Tuple[Any, float]:
+    "Call the function & return its result along with the wall clock time it took (in seconds)"
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# Transcript formats that can be exported (see `whisper.utils.get_writer`)
+EXPORT_FORMATS = ["txt", "srt", "vtt", "tsv", "json"]
+
+
+# Read models
+# -----------
+# Listings & details read just the columns they show with a single joined query, instead of loading ORM objects
+# whose transcript & media relationships would then be lazy loaded with extra queries for every row
+MEDIA_COLUMNS = (
+    Media.id.label("media_id"),
+    Media.source_name,
+    Media.source_type,
+    Media.source_link,
+    Media.filepath.label("filepath"),
+    Media.created.label("media_created"),
+    Transcript.language,
+    Transcript.generated_by,
+    Media.collection,
+)
+SEGMENT_COLUMNS = (Segment.id.label("segment_id"), Segment.number, Segment.start, Segment.end, Segment.text)
+# Media objects are listed & searched through their active transcript
+ACTIVE_MEDIA_TRANSCRIPT = and_(Transcript.media_id == Media.id, Transcript.active.is_(True))
+ACTIVE_SEGMENT_TRANSCRIPT = and_(Transcript.id == Segment.transcript_id, Transcript.active.is_(True))
+
+
+class MediaRow(NamedTuple):
+    media_id: str
+    source_name: str
+    source_type: str
+    source_link: Optional[str]
+    filepath: str
+    media_created: str
+    language: str
+    generated_by: str
+    collection: Optional[str]
+
+
+class SegmentRow(NamedTuple):
+    segment_id: str
+    number: int
+    start: float
+    end: float
+    text: str
+    # The remaining columns are those of the segment's media
+    media: MediaRow
+
+    @classmethod
+    def from_columns(cls, columns: tuple) -> "SegmentRow":
+        "Build a row from the values of `SEGMENT_COLUMNS` followed by those of `MEDIA_COLUMNS`"
+        n_segment_columns = len(SEGMENT_COLUMNS)
+        return cls(*columns[:n_segment_columns], MediaRow(*columns[n_segment_columns:]))
 
 
 # Media manager class
@@ -34,127 +758,185 @@ class MediaManager:
         self.media_dir.mkdir(exist_ok=True, parents=True)
         self.session = Session(ENGINE)
 
-    def _transcribe(self, audio_path: str, whisper_model: str, **whisper_args):
-        """Transcribe the audio file using whisper"""
+    def _new_transcript(self, media_id: str, whisper_model: str, whisper_args: dict, **fields) -> Transcript:
+        "Add a transcript of a media object made with the given model & settings to the session"
+        transcript_obj = Transcript(
+            id=str(uuid.uuid4()),
+            media_id=media_id,
+            generated_by=f"{whisper_args.get('asr_backend', DEFAULT_ASR_BACKEND)}-{whisper_model}",
+            settings=json.dumps(whisper_args),
+            settings_hash=get_settings_hash(whisper_model, whisper_args),
+            **fields,
+        )
+        self.session.add(transcript_obj)
+        return transcript_obj
+
+    def _activate_transcript(self, transcript_obj: Transcript):
+        "Make the transcript the active one of its media object (earlier transcripts are kept, but inactive)"
+        self.session.execute(
+            update(Transcript)
+            .where(Transcript.media_id == transcript_obj.media_id, Transcript.id != transcript_obj.id)
+            .values(active=False, updated=timestamp())
+        )
+        transcript_obj.active = True
 
-        # Get whisper model
-        # NOTE: If mulitple models are selected, this may keep all of them in memory depending on the cache size
-        transcriber = get_whisper_model(whisper_model)
+    def _insert_segments(self, transcript_obj: Transcript, segments: List[dict], first_number: int = 0) -> List[str]:
+        "Add whisper segments to a transcript (numbered from `first_number`) & return their ids"
 
-        # Set configs & transcribe
-        if whisper_args["temperature_increment_on_fallback"] is not None:
-            whisper_args["temperature"] = tuple(
-                np.arange(whisper_args["temperature"], 1.0 + 1e-6, whisper_args["temperature_increment_on_fallback"])
+        # Add all the segments to the database with a single executemany insert rather than one ORM object each
+        segment_ids = [str(uuid.uuid4()) for _ in segments]
+        if segments:
+            self.session.execute(
+                insert(Segment),
+                [
+                    {
+                        "id": segment_id,
+                        "media_id": transcript_obj.media_id,
+                        "transcript_id": transcript_obj.id,
+                        "number": first_number + i,
+                        "text": segment["text"],
+                        "start": segment["start"],
+                        "end": segment["end"],
+                        "generated_by": transcript_obj.generated_by,
+                        "temperature": segment["temperature"],
+                        "avg_logprob": segment["avg_logprob"],
+                        "compression_ratio": segment["compression_ratio"],
+                        "no_speech_prob": segment["no_speech_prob"],
+                    }
+                    for i, (segment_id, segment) in enumerate(zip(segment_ids, segments))
+                ],
             )
-        else:
-            whisper_args["temperature"] = [whisper_args["temperature"]]
 
-        del whisper_args["temperature_increment_on_fallback"]
+        return segment_ids
 
-        transcript = transcriber.transcribe(
-            audio_path,
-            **whisper_args,
+    def _get_cached_transcript(self, audio_hash: Optional[str], settings_hash: str) -> Optional[Transcript]:
+        """Get a transcript of identical audio made with the same settings, if there is one"""
+        # Media added before audio was hashed can't be matched (comparing with NULL would match all of them)
+        if audio_hash is None:
+            return None
+        transcript_obj = (
+            self.session.query(Transcript)
+            .join(Media, Media.id == Transcript.media_id)
+            .filter(
+                Media.audio_hash == audio_hash,
+                Transcript.settings_hash == settings_hash,
+                Transcript.partial.isnot(True),
+            )
+            .first()
         )
+        return transcript_obj
 
-        return transcript
+    def _transcript_dict(self, transcript_obj: Transcript) -> dict:
+        "Rebuild a whisper transcript (see `whisper.transcribe`) from a transcript & its segments in the database"
+        return {
+            "text": transcript_obj.text,
+            "language": transcript_obj.language,
+            "segments": [
+                {
+                    "id": segment.number,
+                    "text": segment.text,
+                    "start": segment.start,
+                    "end": segment.end,
+                    "temperature": segment.temperature,
+                    "avg_logprob": segment.avg_logprob,
+                    "compression_ratio": segment.compression_ratio,
+                    "no_speech_prob": segment.no_speech_prob,
+                }
+                for segment in transcript_obj.segments
+            ],
+        }
 
-    def _transcribe_and_save(self, media_obj: Media, whisper_model: str, **whisper_args):
-        """Transcribe the audio file using whisper and save the transcript to the database"""
+    def _stage_upload(self, source: Any):
+        "Save an uploaded file to the media directory so that a worker can pick it up later"
+        # Parse the file name from the source
+        tokens = source.name.split(".")
+        source_name = ".".join(tokens[:-1])
+        source_format = tokens[-1]
+        # The upload is moved to the directory of its blob once a worker picks it up (see `_store_blob`)
+        save_dir = staging_dir(self.media_dir)
+        save_filename = f"audio.{source_format}"
+        # Save & hash the audio file in fixed size chunks so that memory use doesn't grow with the file size
+        with open(save_dir / save_filename, "wb") as f:
+            writer = HashingWriter(f)
+            size = 0
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE_MB * 2**20:
+                    break
+                writer.write(chunk)
 
-        transcript = self._transcribe(media_obj.filepath, whisper_model, **whisper_args)
+        if size > MAX_UPLOAD_SIZE_MB * 2**20:
+            shutil.rmtree(save_dir)
+            raise ValueError(f"{source.name} is larger than the upload limit of {MAX_UPLOAD_SIZE_MB} MB")
 
-        # Write transcripts into the same directory as the audio file
-        audio_dir = Path(media_obj.filepath).parent
-        writer = whisper.utils.get_writer("all", audio_dir)
-        writer(transcript, "transcript")
+        return source_name, save_dir / save_filename, writer.hexdigest()
 
-        # Add transcript to the database
-        self.session.add(
-            Transcript(
-                media_id=media_obj.id,
-                media=media_obj,
-                text=transcript["text"],
-                language=transcript["language"],
-                generated_by=f"whisper-{whisper_model}",
-            )
+    def _create(
+        self, job: Job, source_name: str, filepath: Path, audio_hash: str, original_size: Optional[int] = None
+    ) -> Media:
+        "Add the downloaded source of a job to the database, storing its audio by content"
+        blob_obj = self._store_blob(audio_hash, filepath)
+
+        # Save the media object to the database
+        media_obj = Media(
+            source_name=source_name,
+            source_type=job.source_type,
+            blob_id=blob_obj.id,
+            filepath=blob_obj.path,
+            audio_hash=audio_hash,
+            duration=probe_duration(blob_obj.path),
+            original_size=original_size,
+            stored_size=blob_obj.size,
         )
+        # Add source link if it is a youtube file
+        if job.source_type == "youtube":
+            media_obj.source_link = job.source
 
-        # Add all the segments to the database
-        for segment in transcript["segments"]:
-            self.session.add(
-                Segment(
-                    media_id=media_obj.id,
-                    media=media_obj,
-                    number=segment["id"],
-                    text=segment["text"],
-                    start=segment["start"],
-                    end=segment["end"],
-                    generated_by=f"whisper-{whisper_model}",
-                    temperature=segment["temperature"],
-                    avg_logprob=segment["avg_logprob"],
-                    compression_ratio=segment["compression_ratio"],
-                    no_speech_prob=segment["no_speech_prob"],
-                )
-            )
-        self.session.commit()
+        self.session.add(media_obj)
+        self.session.flush()
+        job.source_name = source_name
+        job.media_id = media_obj.id
 
-    def _create(self, source_list: List[Union[str, Any]], source_type: str, whisper_model: str, **whisper_args):
-        "Download audio files from the source and save it to the media directory"
-
-        # Iterate over each source in the list & download the file
-        for source in source_list:
-            # If it is a youtube file, download it with pytube
-            if source_type == "youtube":
-                yc = YouTube(source)
-                source_name = yc.title
-                # Remove any non-alphanumeric characters from the source name and replace them with a hyphen for the directory name
-                source_dirname = "".join([c if c.isalnum() else "-" for c in source_name])
-                # itag = 140 is the audio only version
-                # Check if directory already exists. If it does, append the current date and time to the directory name
-                save_dir = self.media_dir / f"{source_dirname}"
-                save_filename = "audio.mp4"
-                if save_dir.exists():
-                    save_dir = self.media_dir / f"""{source_dirname}-{datetime.now().strftime("%Y-%m-%d %H-%M-%S")}"""
-                # Download the audio file
-                yc.streams.get_by_itag(140).download(save_dir, filename=save_filename)
-            elif source_type == "upload":
-                # Parse the file name from the source
-                tokens = source.name.split(".")
-                source_name = ".".join(tokens[:-1])
-                # Remove any non-alphanumeric characters from the source name and replace them with a hyphen
-                source_dirname = "".join([c if c.isalnum() else "-" for c in source_name])
-                source_format = tokens[-1]
-                # Check if directory already exists. If it does, append the current date and time to the directory name
-                save_dir = self.media_dir / f"{source_dirname}"
-                if save_dir.exists():
-                    save_dir = self.media_dir / f"""{source_dirname}-{datetime.now().strftime("%Y-%m-%d %H-%M-%S")}"""
-                # Create the directory
-                save_dir.mkdir(exist_ok=True)
-                save_filename = f"audio.{source_format}"
-                # Save the audio file
-                with open(save_dir / save_filename, "wb") as f:
-                    f.write(source.read())
-
-            # Save the media object to the database
-            media_obj = Media(
-                source_name=source_name,
-                source_type=source_type,
-                filepath=str(save_dir / save_filename),
-            )
-            # Add source link if it is a youtube file
-            if source_type == "youtube":
-                media_obj.source_link = source
+        return media_obj
 
-            self.session.add(media_obj)
+    def _store_blob(self, audio_hash: str, filepath: Path) -> Blob:
+        """Add a reference to the blob of the audio with the given hash & drop the staged file, or move the staged file
+        to the directory of a new blob if there is none
 
-            # Transcribe the audio file
-            self._transcribe_and_save(media_obj, whisper_model, **whisper_args)
+        Only files in a staging directory are dropped, as a file given from elsewhere may be the audio of a blob that
+        other media use.
 
-        # Commit the changes to the database
-        self.session.commit()
+        The reference is taken before the blob's directory is looked at. The first write holds the database's write
+        lock until the commit, & `empty_trash` only moves the directory of a blob out of the way while deleting its
+        row in one transaction, so a blob is either still in use & kept, or gone along with its directory.
+        """
+        result = self.session.execute(
+            update(Blob).where(Blob.hash == audio_hash).values(refcount=Blob.refcount + 1, updated=timestamp())
+        )
+        if result.rowcount == 0:
+            save_dir = blob_dir(self.media_dir, audio_hash)
+            # A directory without a blob is left by a job that failed before it was recorded, & is complete as
+            # staging directories are moved as a whole (& atomically)
+            if not save_dir.exists():
+                save_dir.parent.mkdir(parents=True, exist_ok=True)
+                # Apply the storage policy if the download skipped it for identical audio that has been removed since
+                os.replace(store_audio(filepath).parent, save_dir)
+            stored_path = blob_file(save_dir)
+            self.session.add(Blob(hash=audio_hash, path=str(stored_path), size=stored_size(stored_path), refcount=1))
+            self.session.flush()
+        if is_staged(self.media_dir, filepath):
+            shutil.rmtree(filepath.parent, ignore_errors=True)
+        return self.session.scalar(select(Blob).where(Blob.hash == audio_hash))
+
+    def media_files_dir(self, media_obj: Media) -> Path:
+        "Directory of the files made for a media object (exports & checkpoints), which aren't shared like its audio"
+        if media_obj.blob_id is None:
+            # Media stored before blobs keep them next to their audio
+            return Path(media_obj.filepath).parent
+        return self.media_dir / "files" / media_obj.id[:2] / media_obj.id
 
-    def add(self, source: Union[str, Any], source_type: str, **whisper_args):
-        "Adds a set of media objects to the database from YouTube or uploaded files"
+    def add(self, source: Union[str, Any], source_type: str, **whisper_args) -> List[str]:
+        "Queues a set of media objects from YouTube or uploaded files for download & transcription by a worker"
         # If the source is a YouTube URL, expand it to a list of URLs
         if source_type == "youtube":
             # If the source is a playlist, download all the videos in the playlist
@@ -162,26 +944,606 @@ class MediaManager:
                 source_list = list(Playlist(source))
             else:
                 source_list = [source]
+            jobs = [Job(source_type=source_type, source=url, settings=json.dumps(whisper_args)) for url in source_list]
         elif source_type == "upload":
             source_list = source if type(source) == list else [source]
+            # Uploaded files only live as long as the request, so save them to disk before queueing
+            jobs = []
+            for upload in source_list:
+                try:
+                    source_name, filepath, audio_hash = self._stage_upload(upload)
+                except ValueError:
+                    # Don't leave the files saved so far behind without a job
+                    for job in jobs:
+                        shutil.rmtree(Path(job.source).parent)
+                    raise
+                jobs.append(
+                    Job(
+                        source_type=source_type,
+                        source=str(filepath),
+                        source_name=source_name,
+                        audio_hash=audio_hash,
+                        settings=json.dumps(whisper_args),
+                    )
+                )
+
+        # Add the jobs to the queue
+        self.session.add_all(jobs)
+        self.session.commit()
+
+        return [job.id for job in jobs]
+
+    # Job queue
+    # ---------
+    def claim_job(self, worker: str) -> Optional[str]:
+        "Atomically mark the oldest queued job as running and return its id (or None if the queue is empty)"
+        while True:
+            job_id = self.session.scalar(
+                select(Job.id).where(Job.status == "queued").order_by(Job.created).limit(1)
+            )
+            if job_id is None:
+                return None
+            # Another worker may have claimed the job in the meantime, in which case nothing is updated
+            result = self.session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", worker=worker, started=timestamp(), updated=timestamp())
+            )
+            self.session.commit()
+            if result.rowcount == 1:
+                return job_id
+
+    def get_job(self, job_id: str) -> Job:
+        "Get a job object"
+        return self.session.get(Job, job_id)
+
+    def get_job_media(self, job_id: str) -> Optional[Media]:
+        "Get the media object of a job if its source has already been downloaded (e.g. when a job is retried)"
+        job = self.get_job(job_id)
+        return self.session.get(Media, job.media_id) if job.media_id else None
+
+    def create_job_media(
+        self,
+        job_id: str,
+        source_name: str,
+        filepath: Path,
+        audio_hash: str,
+        download_time: float,
+        original_size: Optional[int] = None,
+    ):
+        "Record the downloaded source of a job"
+        job = self.get_job(job_id)
+        media_obj = self._create(job, source_name, filepath, audio_hash, original_size)
+        job.download_time = download_time
+        self.session.commit()
+        return media_obj
+
+    def reuse_job_transcript(self, job_id: str) -> bool:
+        """Complete a job with a copy of an existing transcript of identical audio with its settings, so that it doesn't
+        need transcribing, & return whether there was one
+
+        The segment vectors of the existing transcript are copied too, before the copy is made active, rather than
+        embedding the segments again. Transcripts whose vectors can't be found (e.g. those made before semantic search)
+        aren't reused, so that the job is transcribed & embedded in a transcription process instead.
+        """
+        start = time.perf_counter()
+        job = self.get_job(job_id)
+        # Jobs that were retried resume the transcript they started instead of saving a copy of it
+        if job.transcript_id is not None:
+            return False
+        settings = json.loads(job.settings)
+        whisper_model = settings.pop("whisper_model")
+        media_obj = self.session.get(Media, job.media_id)
+        source_obj = self._get_cached_transcript(media_obj.audio_hash, get_settings_hash(whisper_model, settings))
+        if source_obj is None:
+            return False
+
+        transcript_obj = self._new_transcript(
+            media_obj.id, whisper_model, settings, text=source_obj.text, language=source_obj.language
+        )
+        segment_ids = self._insert_segments(transcript_obj, self._transcript_dict(source_obj)["segments"])
+        source_segment_ids = [segment.id for segment in source_obj.segments]
+        if not SEGMENT_INDEX.copy(
+            media_obj.id, transcript_obj.id, segment_ids, source_obj.media_id, source_obj.id, source_segment_ids
+        ):
+            self.session.rollback()
+            return False
 
-        # Download & save the audio files and add them to the database
-        self._create(source_list=source_list, source_type=source_type, **whisper_args)
+        self._activate_transcript(transcript_obj)
+        job.transcript_id = transcript_obj.id
+        job.transcribe_time = 0.0
+        job.save_time = time.perf_counter() - start
+        self.finish_job(job_id)
+        return True
+
+    def start_job_transcript(self, job_id: str) -> float:
+        """Create the transcript that a job saves segments to as they are decoded & return the offset to start from
+
+        The offset (in seconds) is 0 for a new job, or the end of the last saved window if the job was interrupted.
+        """
+        job = self.get_job(job_id)
+        if job.transcript_id is None:
+            settings = json.loads(job.settings)
+            whisper_model = settings.pop("whisper_model")
+            # The transcript stays hidden until all of it is saved
+            transcript_obj = self._new_transcript(
+                job.media_id, whisper_model, settings, text="", language="", active=False, partial=True
+            )
+            job.transcript_id = transcript_obj.id
+            job.checkpoint = 0.0
+            job.updated = timestamp()
+            self.session.commit()
+
+        return job.checkpoint
+
+    def save_job_window(self, job_id: str, transcript: dict, end: float):
+        "Save the segments of a window of a job's audio along with the offset reached, in a single transaction"
+        job = self.get_job(job_id)
+        transcript_obj = self.session.get(Transcript, job.transcript_id)
+        n_segments = self.session.scalar(select(func.count()).where(Segment.transcript_id == transcript_obj.id))
+        self._insert_segments(transcript_obj, transcript["segments"], first_number=n_segments)
+        if not transcript_obj.language:
+            transcript_obj.language = transcript["language"]
+        job.skipped_duration = (job.skipped_duration or 0.0) + transcript.get("skipped_duration", 0.0)
+        job.checkpoint = end
+        job.updated = timestamp()
+        self.session.commit()
+
+    def set_job_duration(self, job_id: str, duration: float):
+        "Record the duration (in seconds) of a job's media, if it isn't known yet"
+        media_obj = self.get_job_media(job_id)
+        if media_obj.duration is None:
+            media_obj.duration = duration
+            self.session.commit()
+
+    def stream_job(self, job_id: str, poll_interval: float = 1.0) -> Iterator[dict]:
+        """Follow a job as it is transcribed, yielding its progress & the segments saved since the previous update
+
+        Segments are read from the database as the job's process saves them (see `transcribe_job`), so this works
+        from any process. Stops after the update in which the job is done or failed.
+        """
+        next_number = 0
+        while True:
+            # The job is updated by another process, so don't use what this session has loaded before
+            self.session.expire_all()
+            job = self.get_job(job_id)
+            media_obj = self.get_job_media(job_id)
+            segment_rows = []
+            if job.transcript_id is not None:
+                segment_rows = self.session.execute(
+                    select(Segment.number, Segment.start, Segment.end, Segment.text)
+                    .where(Segment.transcript_id == job.transcript_id, Segment.number >= next_number)
+                    .order_by(Segment.number)
+                ).all()
+                next_number += len(segment_rows)
+
+            yield {
+                "status": job.status,
+                "error": job.error,
+                "media_id": job.media_id,
+                # Seconds of audio transcribed so far & in total (once known)
+                "transcribed": job.checkpoint or 0.0,
+                "duration": media_obj.duration if media_obj is not None else None,
+                "segments": [
+                    {"number": segment.number, "start": segment.start, "end": segment.end, "text": segment.text}
+                    for segment in segment_rows
+                ],
+            }
+            if job.status in ("done", "failed"):
+                return
+            time.sleep(poll_interval)
+
+    def complete_job_transcript(self, job_id: str, transcribe_time: float, resources: Optional[dict] = None):
+        """Make the transcript a job saved window by window the active transcript of its media object & finish the job
+
+        The transcription is also recorded in the metrics, along with the `resources` reported by `transcribe_job`.
+        """
+        start = time.perf_counter()
+        # The windows were saved by a transcription process, so don't use what this session has loaded before
+        self.session.expire_all()
+        job = self.get_job(job_id)
+        transcript_obj = self.session.get(Transcript, job.transcript_id)
+        texts = self.session.scalars(
+            select(Segment.text).where(Segment.transcript_id == transcript_obj.id).order_by(Segment.number)
+        ).all()
+        # The full text is only set now, so that the full-text index isn't updated for every window
+        transcript_obj.text = "".join(texts)
+        transcript_obj.partial = False
+        self._activate_transcript(transcript_obj)
+        self.session.commit()
+
+        # Drop the chunk transcripts of the long file mode (the segments were indexed by `index_job_transcript`)
+        shutil.rmtree(job_checkpoint_dir(self.media_files_dir(transcript_obj.media), job_id), ignore_errors=True)
+
+        self._add_transcription_metric(job, transcript_obj, transcribe_time, resources or {})
+        job.transcribe_time = transcribe_time
+        job.save_time = time.perf_counter() - start
+        self.finish_job(job_id)
+
+    def index_job_transcript(self, job_id: str):
+        """Embed the segments of the transcript a job saved for semantic search
+
+        This runs in the transcription process before the transcript is completed, so that the worker doesn't wait on
+        it & a transcript that fails to be indexed stays hidden until its job is retried.
+        """
+        job = self.get_job(job_id)
+        segment_rows = self.session.execute(
+            select(Segment.id, Segment.text).where(Segment.transcript_id == job.transcript_id).order_by(Segment.number)
+        ).all()
+        texts = [segment_row.text for segment_row in segment_rows]
+        SEGMENT_INDEX.add(job.media_id, job.transcript_id, [segment_row.id for segment_row in segment_rows], texts)
+
+    def _add_transcription_metric(self, job: Job, transcript_obj: Transcript, wall_time: float, resources: dict):
+        "Record how long a job took to transcribe relative to the audio length & what it used"
+        settings = json.loads(job.settings)
+        duration = self.session.get(Media, job.media_id).duration
+        # Segments decoded at a higher temperature than the first one needed a fallback
+        fallback_count = self.session.scalar(
+            select(func.count()).where(
+                Segment.transcript_id == transcript_obj.id, Segment.temperature > settings["temperature"]
+            )
+        )
+        self.session.add(
+            TranscriptionMetric(
+                job_id=job.id,
+                media_id=job.media_id,
+                transcript_id=transcript_obj.id,
+                asr_backend=settings.get("asr_backend", DEFAULT_ASR_BACKEND),
+                whisper_model=settings["whisper_model"],
+                audio_duration=duration,
+                wall_time=wall_time,
+                real_time_factor=wall_time / duration if duration else None,
+                threads=resources.get("threads"),
+                peak_rss_mb=resources.get("peak_rss_mb"),
+                fallback_count=fallback_count,
+                skipped_duration=job.skipped_duration,
+            )
+        )
+
+    def get_transcription_stats(self) -> List[dict]:
+        "Aggregate transcription metrics per backend & model, e.g. to plan capacity by hours of audio per core"
+        # Metrics recorded before there were several backends are of the default one
+        asr_backend = func.coalesce(TranscriptionMetric.asr_backend, DEFAULT_ASR_BACKEND)
+        metric_rows = self.session.execute(
+            select(
+                asr_backend,
+                TranscriptionMetric.whisper_model,
+                func.count(),
+                func.sum(TranscriptionMetric.audio_duration),
+                func.sum(TranscriptionMetric.wall_time),
+                func.sum(TranscriptionMetric.wall_time * TranscriptionMetric.threads),
+                func.avg(TranscriptionMetric.real_time_factor),
+                func.max(TranscriptionMetric.peak_rss_mb),
+                func.sum(TranscriptionMetric.fallback_count),
+                func.sum(func.coalesce(TranscriptionMetric.skipped_duration, 0.0)),
+            )
+            .where(TranscriptionMetric.audio_duration.isnot(None))
+            .group_by(asr_backend, TranscriptionMetric.whisper_model)
+            .order_by(asr_backend, TranscriptionMetric.whisper_model)
+        )
+        return [
+            {
+                "asr_backend": backend,
+                "whisper_model": whisper_model,
+                "transcriptions": count,
+                "audio_hours": audio_duration / 3600,
+                "wall_hours": wall_time / 3600,
+                "mean_real_time_factor": real_time_factor,
+                # Hours of audio transcribed per hour of one CPU thread
+                "audio_hours_per_core_hour": audio_duration / core_time if core_time else None,
+                "max_peak_rss_mb": peak_rss,
+                "fallbacks": fallbacks,
+                # Share of the audio that the voice activity filter didn't pass to the model
+                "skipped_fraction": skipped_duration / audio_duration if audio_duration else 0.0,
+            }
+            for (
+                backend,
+                whisper_model,
+                count,
+                audio_duration,
+                wall_time,
+                core_time,
+                real_time_factor,
+                peak_rss,
+                fallbacks,
+                skipped_duration,
+            ) in metric_rows
+        ]
+
+    def get_storage_stats(self) -> dict:
+        """Total size of the media as downloaded & as stored (see `config.STORAGE_POLICY`), where their sizes are known
+
+        Identical media share their stored files, which only count once.
+        """
+        count, original_size, unshared_size = self.session.execute(
+            select(
+                func.count(), func.sum(Media.original_size), func.sum(Media.stored_size).filter(Media.blob_id.is_(None))
+            ).where(Media.original_size.isnot(None))
+        ).one()
+        blob_size = self.session.scalar(select(func.sum(Blob.size)).where(Blob.refcount > 0)) or 0
+        return {"media": count, "original_size": original_size or 0, "stored_size": (unshared_size or 0) + blob_size}
+
+    def requeue_interrupted_jobs(self, hostname: str) -> List[str]:
+        """Put running jobs whose worker process on this host is gone back on the queue & return their ids
+
+        Jobs resume from their last checkpoint when they are claimed again.
+        """
+        job_ids = []
+        for job_obj in self.session.query(Job).filter(Job.status == "running", Job.worker.like(f"{hostname}:%")):
+            if pid_exists(int(job_obj.worker.rsplit(":", 1)[1])):
+                continue
+            job_obj.status = "queued"
+            job_obj.worker = None
+            job_obj.started = None
+            job_obj.updated = timestamp()
+            job_ids.append(job_obj.id)
+        self.session.commit()
+
+        return job_ids
+
+    def finish_job(self, job_id: str, error: Optional[str] = None):
+        "Mark a job as done, or as failed if an error is given"
+        # Discard anything left over from the failed step
+        if error is not None:
+            self.session.rollback()
+        job = self.get_job(job_id)
+        job.status = "done" if error is None else "failed"
+        job.error = error
+        job.finished = timestamp()
+        job.updated = timestamp()
+        self.session.commit()
+
+    def is_retryable(self, job: Job) -> bool:
+        """Whether a failed job can be put back on the queue
+
+        Jobs without a media object download their source again, which for uploads is the staged file. Re-transcriptions
+        of uploads whose media was deleted point at the audio the media used instead, & so can't be retried.
+        """
+        return job.media_id is not None or job.source_type != "upload" or is_staged(self.media_dir, job.source)
+
+    def retry_job(self, job_id: str):
+        "Put a failed job back on the queue"
+        job = self.session.get(Job, job_id)
+        if not self.is_retryable(job):
+            raise ValueError("The media of this job was deleted, add it again to transcribe it")
+        job.status = "queued"
+        job.error = None
+        job.worker = None
+        job.started = None
+        job.finished = None
+        job.updated = timestamp()
+        self.session.commit()
+
+    def get_jobs(self, **filters):
+        "List the most recent jobs in the queue"
+        job_objs = self.session.query(Job)
+        if "status" in filters:
+            job_objs = job_objs.filter(Job.status == filters["status"])
+        job_objs = job_objs.order_by(Job.created.desc()).limit(filters.get("limit", 20))
+        return [self._format_job(job_obj) for job_obj in job_objs.all()]
 
     def delete(self, media_id: str):
         "Delete a media object from the database"
-        # Get the media object
-        media_obj = self.session.query(Media).filter(Media.id == media_id).first()
-        # Delete the media object
-        self.session.delete(media_obj)
-        # Commit the changes to the database
+        self.delete_many([media_id])
+
+    # Bulk operations
+    # ---------------
+    # NOTE: These change any number of media objects with a few statements & a single commit
+    def delete_many(self, media_ids: List[str]) -> int:
+        """Delete media objects along with their transcripts & segments in a single transaction & return how many
+        were deleted
+
+        Their files (audio, exports & segment vectors) are moved to the trash & removed in the background by
+        `empty_trash`, so deleting doesn't wait on the disk.
+        """
+        media_objs = self.session.scalars(select(Media).where(Media.id.in_(media_ids))).all()
+        trash_objs = [
+            Trash(path=str(self.media_files_dir(media_obj)), media_id=media_obj.id) for media_obj in media_objs
+        ]
+        # Drop the references to their blobs, whose files are removed once no media object uses them
+        blob_references = Counter(media_obj.blob_id for media_obj in media_objs if media_obj.blob_id is not None)
+        for blob_id, count in blob_references.items():
+            self.session.execute(
+                update(Blob).where(Blob.id == blob_id).values(refcount=Blob.refcount - count, updated=timestamp())
+            )
+        unused_blob_rows = self.session.execute(
+            select(Blob.id, Blob.path).where(Blob.id.in_(list(blob_references)), Blob.refcount <= 0)
+        ).all()
+        trash_objs.extend(Trash(path=str(Path(path).parent), blob_id=blob_id) for blob_id, path in unused_blob_rows)
+
+        # Re-transcriptions that haven't started would have no audio. They are failed rather than deleted so that
+        # whoever follows them (e.g. the live transcript of the Whisper page) sees why
+        self.session.execute(
+            update(Job)
+            .where(Job.media_id.in_(media_ids), Job.status == "queued")
+            .values(
+                status="failed",
+                error="The media was deleted before it was transcribed",
+                finished=timestamp(),
+                updated=timestamp(),
+            )
+        )
+        # Every job of the media is detached from it & its transcripts here, as foreign keys aren't enforced by SQLite
+        # (so their ON DELETE SET NULL doesn't apply). Jobs that are retried then start over (see `is_retryable`)
+        self.session.execute(
+            update(Job)
+            .where(Job.media_id.in_(media_ids))
+            .values(media_id=None, transcript_id=None, checkpoint=None, skipped_duration=None, updated=timestamp())
+        )
+        self.session.execute(delete(Segment).where(Segment.media_id.in_(media_ids)))
+        self.session.execute(delete(Transcript).where(Transcript.media_id.in_(media_ids)))
+        self.session.execute(delete(Media).where(Media.id.in_(media_ids)))
+        self.session.add_all(trash_objs)
         self.session.commit()
-        # Remove the audio file directory
-        shutil.rmtree(Path(media_obj.filepath).parent)
+        return len(media_objs)
 
-    def get_segments(self, **filters):
-        "Get all the segments in the database"
+    def move_many(self, media_ids: List[str], collection: Optional[str]):
+        "File media objects in a collection (or in none if it's empty)"
+        self.session.execute(
+            update(Media).where(Media.id.in_(media_ids)).values(collection=collection or None, updated=timestamp())
+        )
+        self.session.commit()
+
+    def retranscribe_many(self, media_ids: List[str], whisper_model: str, **whisper_args) -> List[str]:
+        """Queue new transcripts of media objects in a single transaction & return the ids of the jobs queued
 
+        Media objects that already have a transcript with the same settings have it made active instead, as with
+        `retranscribe`.
+        """
+        transcript_ids = dict(
+            self.session.execute(
+                select(Transcript.media_id, Transcript.id).where(
+                    Transcript.media_id.in_(media_ids),
+                    Transcript.settings_hash == get_settings_hash(whisper_model, whisper_args),
+                    Transcript.partial.isnot(True),
+                )
+            ).all()
+        )
+        for media_id, transcript_id in transcript_ids.items():
+            self._set_active_transcript(media_id, transcript_id)
+
+        media_objs = self.session.scalars(
+            select(Media).where(Media.id.in_(media_ids), Media.id.notin_(list(transcript_ids)))
+        ).all()
+        job_ids = []
+        for media_obj in media_objs:
+            job = Job(
+                # Set here so that the ids can be returned without reloading the jobs after the commit
+                id=str(uuid.uuid4()),
+                source_type=media_obj.source_type,
+                source=media_obj.source_link or media_obj.filepath,
+                source_name=media_obj.source_name,
+                audio_hash=media_obj.audio_hash,
+                settings=json.dumps({"whisper_model": whisper_model, **whisper_args}),
+                # Jobs for media objects that exist already skip the download
+                media_id=media_obj.id,
+            )
+            self.session.add(job)
+            job_ids.append(job.id)
+        self.session.commit()
+
+        return job_ids
+
+    def get_collections(self) -> List[str]:
+        "Names of the collections that media objects are filed in"
+        return list(
+            self.session.scalars(
+                select(Media.collection).where(Media.collection.isnot(None)).distinct().order_by(Media.collection)
+            )
+        )
+
+    def empty_trash(self, limit: int = 100) -> int:
+        "Remove the files of (up to `limit`) deleted media objects from disk & return how many were removed"
+        trash_objs = self.session.scalars(select(Trash).order_by(Trash.created).limit(limit)).all()
+        # Blobs that no media object uses are deleted & their directories moved out of the way in one transaction, so
+        # `_store_blob` (which takes its reference first) either keeps a blob in use or stores the audio in a new
+        # directory. Blobs that new identical media use again since they were released keep their files
+        kept_trash_ids = set()
+        for trash_obj in trash_objs:
+            if trash_obj.blob_id is None:
+                continue
+            result = self.session.execute(delete(Blob).where(Blob.id == trash_obj.blob_id, Blob.refcount <= 0))
+            if result.rowcount == 0:
+                kept_trash_ids.add(trash_obj.id)
+            elif os.path.exists(trash_obj.path):
+                tombstone_path = Path(trash_obj.path).with_name(f".{uuid.uuid4()}")
+                os.replace(trash_obj.path, tombstone_path)
+                trash_obj.path = str(tombstone_path)
+            # The entry is now a plain directory, which is removed even if this is interrupted before it is
+            trash_obj.blob_id = None
+        self.session.commit()
+        for trash_obj in trash_objs:
+            if trash_obj.id not in kept_trash_ids:
+                shutil.rmtree(trash_obj.path, ignore_errors=True)
+            if trash_obj.media_id is not None:
+                SEGMENT_INDEX.remove(trash_obj.media_id)
+        # NOTE: Another process may be emptying the same entries, which is harmless as removing files is idempotent
+        self.session.execute(delete(Trash).where(Trash.id.in_([trash_obj.id for trash_obj in trash_objs])))
+        self.session.commit()
+        return len(trash_objs)
+
+    # Transcripts
+    # -----------
+    def retranscribe(self, media_id: str, whisper_model: str, **whisper_args) -> Optional[str]:
+        """Queue a new transcript of a media object with another model or settings & return the job id
+
+        The stored audio is reused, so only inference is needed. The new transcript becomes the active one once it is
+        done, while the earlier ones are kept. If the media object already has a transcript with the same settings,
+        that transcript is made active instead & no job is queued (None is returned).
+        """
+        job_ids = self.retranscribe_many([media_id], whisper_model, **whisper_args)
+        return job_ids[0] if job_ids else None
+
+    def set_active_transcript(self, media_id: str, transcript_id: str):
+        "Make one of the transcripts of a media object the one that is shown & searched"
+        self._set_active_transcript(media_id, transcript_id)
+        self.session.commit()
+
+    def _set_active_transcript(self, media_id: str, transcript_id: str):
+        self.session.execute(
+            update(Transcript)
+            .where(Transcript.media_id == media_id)
+            .values(active=Transcript.id == transcript_id, updated=timestamp())
+        )
+
+    def export_transcript(self, transcript_id: str, output_format: str) -> Path:
+        """Write a transcript to a file in one of the whisper output formats & return its path
+
+        Files are generated from the segments in the database when they are first asked for & cached in an exports
+        directory per transcript among the files of the media object. A new transcription gets a new directory, so
+        cached files never go stale.
+        """
+        if output_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {output_format}, use one of {', '.join(EXPORT_FORMATS)}")
+
+        transcript_obj = self.session.get(Transcript, transcript_id)
+        export_dir = self.media_files_dir(transcript_obj.media) / "exports" / transcript_id
+        export_path = export_dir / f"transcript.{output_format}"
+        if export_path.exists():
+            return export_path
+
+        # Write to a temporary directory first so that a partially written file is never served
+        tmp_dir = export_dir / f".{uuid.uuid4()}"
+        tmp_dir.mkdir(parents=True)
+        try:
+            writer = whisper.utils.get_writer(output_format, tmp_dir)
+            writer(self._transcript_dict(transcript_obj), "transcript")
+            os.replace(tmp_dir / export_path.name, export_path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return export_path
+
+    def get_transcripts(self, media_id: str):
+        "List the transcripts of a media object, oldest first"
+        transcript_rows = self.session.execute(
+            select(
+                Transcript.id,
+                Transcript.generated_by,
+                Transcript.language,
+                Transcript.settings,
+                Transcript.active,
+                Transcript.partial,
+                Transcript.created,
+            )
+            .where(Transcript.media_id == media_id)
+            .order_by(Transcript.created)
+        )
+        return [
+            {
+                "id": transcript_row.id,
+                "generated_by": transcript_row.generated_by,
+                "language": transcript_row.language,
+                "settings": json.loads(transcript_row.settings) if transcript_row.settings else {},
+                "active": bool(transcript_row.active),
+                "partial": bool(transcript_row.partial),
+                "created": transcript_row.created,
+            }
+            for transcript_row in transcript_rows
+        ]
+
+    def _segment_filter_args(self, **filters):
+        "Filters for segment queries (other than search by transcript)"
         filter_args = []
 
         if "start_date" in filters:
@@ -197,24 +1559,112 @@ class MediaManager:
         if "source_type" in filters:
             filter_args.append(Media.source_type == filters["source_type"])
 
+        if "collection" in filters:
+            filter_args.append(Media.collection == filters["collection"])
+
         if "search_by_name" in filters:
             filter_args.append(Media.source_name.like(f"""%{filters["search_by_name"]}%"""))
 
-        if "search_by_transcript" in filters:
-            filter_args.append(Segment.text.like(f"""%{filters["search_by_transcript"]}%"""))
+        return filter_args
+
+    def get_segments(self, **filters):
+        "Get all the segments in the database"
+
+        filter_args = self._segment_filter_args(**filters)
 
         # Get the media objects
-        segment_objs = self.session.query(Segment).join(Media)
+        # NOTE: Searches by transcript use the full-text index, rank the results by relevance (BM25) & highlight the
+        # matching words
+        # NOTE: Pages are fetched with keyset pagination: `cursor` is the sort key of the last item of the previous
+        # page & results continue after it (using the indexes), so every page costs the same as the first one
+        cursor = filters.get("cursor")
+        if fts_query(filters.get("search_by_transcript", "")):
+            segment_rowid = literal_column("segment.rowid")
+            segment_objs = (
+                self.session.query(
+                    *SEGMENT_COLUMNS, *MEDIA_COLUMNS, fts_snippet("segment_fts"), segment_fts.c.rank, segment_rowid
+                )
+                .select_from(Segment)
+                .join(Media)
+                .join(Transcript, ACTIVE_SEGMENT_TRANSCRIPT)
+                .join(segment_fts, segment_fts.c.rowid == segment_rowid)
+                .filter(text("segment_fts MATCH :search"))
+                .params(search=fts_query(filters["search_by_transcript"]))
+                .order_by(segment_fts.c.rank, segment_rowid)
+            )
+            if cursor:
+                filter_args.append(
+                    or_(
+                        segment_fts.c.rank > cursor["rank"],
+                        and_(segment_fts.c.rank == cursor["rank"], segment_rowid > cursor["rowid"]),
+                    )
+                )
+        else:
+            segment_objs = (
+                self.session.query(*SEGMENT_COLUMNS, *MEDIA_COLUMNS, null(), null(), null())
+                .select_from(Segment)
+                .join(Media)
+                .join(Transcript, ACTIVE_SEGMENT_TRANSCRIPT)
+                .order_by(Media.created.desc(), Media.id.desc(), Segment.number)
+            )
+            # NOTE: The upper bound on the creation date (even on the first page) makes SQLite walk media objects in
+            # order using the index & their segments using the (media_id, number) index, instead of sorting all segments
+            max_created = cursor["created"] if cursor else self.session.scalar(select(func.max(Media.created)))
+            if max_created is not None:
+                filter_args.append(Media.created <= max_created)
+            if cursor:
+                filter_args.append(
+                    or_(
+                        Media.created < cursor["created"],
+                        Media.id < cursor["media_id"],
+                        and_(Media.id == cursor["media_id"], Segment.number > cursor["number"]),
+                    )
+                )
 
         # Filter the media objects
         if len(filter_args) > 0:
             segment_objs = segment_objs.filter(*filter_args)
 
-        # Sort the media objects by creation date
-        segment_objs = segment_objs.order_by(Media.created.desc()).limit(filters.get("limit", 10))
+        segment_objs = segment_objs.limit(filters.get("limit", 10))
 
         # Finally, format media objects into a list of dictionaries
-        formatted_segment_list = [self._format_segment(segment_obj) for segment_obj in segment_objs.all()]
+        formatted_segment_list = []
+        for *segment_row, snippet, rank, rowid in segment_objs.all():
+            formatted_segment = self._format_segment(SegmentRow.from_columns(segment_row), snippet)
+            if rank is None:
+                formatted_segment["cursor"] = {
+                    "created": formatted_segment["media"]["created"],
+                    "media_id": formatted_segment["media"]["id"],
+                    "number": formatted_segment["number"],
+                }
+            else:
+                formatted_segment["cursor"] = {"rank": rank, "rowid": rowid}
+            formatted_segment_list.append(formatted_segment)
+
+        return formatted_segment_list
+
+    def semantic_search(self, query: str, k: int = 10, **filters):
+        "Get the k segments closest in meaning to the query (that match the filters), most similar first"
+        # Fetch extra candidates to leave enough after filtering & dropping segments of inactive transcripts
+        scores = dict(SEGMENT_INDEX.search(query, k * 5))
+        if not scores:
+            return []
+
+        segment_rows = (
+            self.session.query(*SEGMENT_COLUMNS, *MEDIA_COLUMNS)
+            .select_from(Segment)
+            .join(Media)
+            .join(Transcript, ACTIVE_SEGMENT_TRANSCRIPT)
+            .filter(Segment.id.in_(scores), *self._segment_filter_args(**filters))
+            .all()
+        )
+        segment_rows = sorted(segment_rows, key=lambda row: scores[row.segment_id], reverse=True)[:k]
+
+        formatted_segment_list = []
+        for segment_row in segment_rows:
+            formatted_segment = self._format_segment(SegmentRow.from_columns(segment_row))
+            formatted_segment["score"] = scores[segment_row.segment_id]
+            formatted_segment_list.append(formatted_segment)
 
         return formatted_segment_list
 
@@ -237,50 +1687,115 @@ class MediaManager:
         if "source_type" in filters:
             filter_args.append(Media.source_type == filters["source_type"])
 
+        if "collection" in filters:
+            filter_args.append(Media.collection == filters["collection"])
+
         if "search_by_name" in filters:
             filter_args.append(Media.source_name.like(f"""%{filters["search_by_name"]}%"""))
 
-        if "search_by_transcript" in filters:
-            filter_args.append(Transcript.text.like(f"""%{filters["search_by_transcript"]}%"""))
-
         # Get the media objects
-        media_objs = self.session.query(Media).join(Transcript)
+        # NOTE: Searches by transcript use the full-text index, rank the results by relevance (BM25) & highlight the
+        # matching words
+        # NOTE: Pages are fetched with keyset pagination, see `get_segments`
+        cursor = filters.get("cursor")
+        if fts_query(filters.get("search_by_transcript", "")):
+            transcript_rowid = literal_column("transcript.rowid")
+            media_objs = (
+                self.session.query(
+                    *MEDIA_COLUMNS, fts_snippet("transcript_fts"), transcript_fts.c.rank, transcript_rowid
+                )
+                .select_from(Media)
+                .join(Transcript, ACTIVE_MEDIA_TRANSCRIPT)
+                .join(transcript_fts, transcript_fts.c.rowid == transcript_rowid)
+                .filter(text("transcript_fts MATCH :search"))
+                .params(search=fts_query(filters["search_by_transcript"]))
+                .order_by(transcript_fts.c.rank, transcript_rowid)
+            )
+            if cursor:
+                filter_args.append(
+                    or_(
+                        transcript_fts.c.rank > cursor["rank"],
+                        and_(transcript_fts.c.rank == cursor["rank"], transcript_rowid > cursor["rowid"]),
+                    )
+                )
+        else:
+            media_objs = (
+                self.session.query(*MEDIA_COLUMNS, null(), null(), null())
+                .select_from(Media)
+                .join(Transcript, ACTIVE_MEDIA_TRANSCRIPT)
+                .order_by(Media.created.desc(), Media.id.desc())
+            )
+            if cursor:
+                filter_args.append(tuple_(Media.created, Media.id) < tuple_(cursor["created"], cursor["id"]))
 
         # Filter the media objects
         if len(filter_args) > 0:
             media_objs = media_objs.filter(*filter_args)
 
-        # Sort the media objects by creation date
-        media_objs = media_objs.order_by(Media.created.desc()).limit(filters.get("limit", 10))
+        media_objs = media_objs.limit(filters.get("limit", 10))
 
         # Finally, format media objects into a list of dictionaries
-        formatted_media_list = [self._format_media_base(media_obj) for media_obj in media_objs.all()]
+        formatted_media_list = []
+        for *media_row, snippet, rank, rowid in media_objs.all():
+            media_row = MediaRow(*media_row)
+            formatted_media = self._format_media_base(media_row)
+            formatted_media["snippet"] = snippet
+            if rank is None:
+                formatted_media["cursor"] = {"created": media_row.media_created, "id": media_row.media_id}
+            else:
+                formatted_media["cursor"] = {"rank": rank, "rowid": rowid}
+            formatted_media_list.append(formatted_media)
 
         return formatted_media_list
 
-    def get_detail(self, media_id: str):
-        "Get the details of a media object"
-        media_obj = self.session.query(Media).filter(Media.id == media_id).first()
-        return self._format_media_detail(media_obj)
+    def get_detail(self, media_id: str, transcript_id: Optional[str] = None):
+        "Get the details of a media object with its active transcript (or another one of its transcripts)"
+        transcript_filter = Transcript.active.is_(True) if transcript_id is None else Transcript.id == transcript_id
+        row = (
+            self.session.query(*MEDIA_COLUMNS, Media.original_size, Media.stored_size, Transcript.id, Transcript.text)
+            .select_from(Media)
+            .join(Transcript, and_(Transcript.media_id == Media.id, transcript_filter))
+            .filter(Media.id == media_id)
+            .one_or_none()
+        )
+        if row is None and transcript_id is not None:
+            # The transcript belongs to another (or a deleted) media object: show the active one instead
+            return self.get_detail(media_id)
+        if row is None:
+            raise NoResultFound(f"Media {media_id} not found")
+        *media_row, original_size, stored_size, transcript_id, transcript_text = row
+        segment_rows = (
+            self.session.query(Segment.number, Segment.start, Segment.end, Segment.text)
+            .filter(Segment.transcript_id == transcript_id)
+            .order_by(Segment.number)
+            .all()
+        )
+        media = self._format_media_detail(MediaRow(*media_row), transcript_text, segment_rows)
+        media["transcript_id"] = transcript_id
+        # Disk space saved by the storage policy (unknown for media stored before sizes were recorded)
+        media["original_size"] = original_size
+        media["stored_size"] = stored_size
+        return media
 
-    def _format_media_base(self, media_obj: Media):
-        "Formats the media object to a dictionary"
+    def _format_media_base(self, media_row: MediaRow):
+        "Formats the media row to a dictionary"
         return {
-            "id": media_obj.id,
-            "source_name": media_obj.source_name,
-            "source_type": media_obj.source_type,
-            "source_link": media_obj.source_link,
-            "filepath": media_obj.filepath,
-            "created": media_obj.created,
-            "language": media_obj.transcript.language,
-            "generated_by": media_obj.transcript.generated_by,
+            "id": media_row.media_id,
+            "source_name": media_row.source_name,
+            "source_type": media_row.source_type,
+            "source_link": media_row.source_link,
+            "filepath": media_row.filepath,
+            "created": media_row.media_created,
+            "language": media_row.language,
+            "generated_by": media_row.generated_by,
+            "collection": media_row.collection,
         }
 
-    def _format_media_detail(self, media_obj: Media):
-        "Formats the media object to a dictionary"
-        base = self._format_media_base(media_obj)
+    def _format_media_detail(self, media_row: MediaRow, transcript_text: str, segment_rows: List[Row]):
+        "Formats the media row & its transcript to a dictionary"
+        base = self._format_media_base(media_row)
         details = {
-            "transcript": media_obj.transcript.text,
+            "transcript": transcript_text,
             "segments": [
                 {
                     "number": segment.number,
@@ -288,19 +1803,183 @@ class MediaManager:
                     "end": segment.end,
                     "text": segment.text,
                 }
-                for segment in media_obj.segments
+                for segment in segment_rows
             ],
         }
         base.update(details)
         return base
 
-    def _format_segment(self, segment_obj: Segment):
-        """Formats the segment object to a dictionary"""
+    def _format_job(self, job_obj: Job):
+        "Formats the job object to a dictionary"
         return {
-            "id": segment_obj.id,
-            "number": segment_obj.number,
-            "start": segment_obj.start,
-            "end": segment_obj.end,
-            "text": segment_obj.text,
-            "media": self._format_media_base(segment_obj.media),
+            "id": job_obj.id,
+            "source_type": job_obj.source_type,
+            "source": job_obj.source,
+            "source_name": job_obj.source_name,
+            "status": job_obj.status,
+            "error": job_obj.error,
+            "worker": job_obj.worker,
+            "created": job_obj.created,
+            "started": job_obj.started,
+            "finished": job_obj.finished,
+            "media_id": job_obj.media_id,
+            "download_time": job_obj.download_time,
+            "transcribe_time": job_obj.transcribe_time,
+            "save_time": job_obj.save_time,
+            "retryable": job_obj.status == "failed" and self.is_retryable(job_obj),
         }
+
+    def _format_segment(self, segment_row: SegmentRow, snippet: Optional[str] = None):
+        """Formats the segment row to a dictionary"""
+        return {
+            "id": segment_row.segment_id,
+            "number": segment_row.number,
+            "start": segment_row.start,
+            "end": segment_row.end,
+            "text": segment_row.text,
+            "snippet": snippet,
+            "media": self._format_media_base(segment_row.media),
+        }
+
+
+# Job transcription
+# -----------------
+def transcribe_job(job_id: str) -> dict:
+    """Transcribe the media of a job, saving the segments as they are decoded so that an interrupted job resumes
+
+    Files are transcribed window by window & each window is saved to the database along with the offset reached.
+    Long files transcribed in parallel chunks (which finish out of order) save each chunk's transcript to disk
+    instead. The segments are then embedded for semantic search & the transcript is completed with
+    `MediaManager.complete_job_transcript`, which is passed the resources returned by this function. This is a plain
+    function (rather than a method) so that it can run in a worker process.
+    """
+    reset_peak_rss()
+    media_manager = MediaManager()
+    try:
+        start = media_manager.start_job_transcript(job_id)
+        settings = json.loads(media_manager.get_job(job_id).settings)
+        audio_path = media_manager.get_job_media(job_id).filepath
+        threads, chunk_peak_rss = _transcribe_job(media_manager, job_id, audio_path, start, **settings)
+        media_manager.index_job_transcript(job_id)
+    finally:
+        media_manager.session.close()
+
+    # Report what the transcription used, for the transcription metrics
+    return {"threads": threads, "peak_rss_mb": max(peak_rss_mb(), chunk_peak_rss)}
+
+
+def transcribe_job_batch(job_ids: List[str]) -> dict:
+    """Transcribe the short clips of several jobs with the same settings in one batch (see `transcribe_batch`)
+
+    Each clip is saved as a single window of its job, so the jobs are completed like any other with
+    `MediaManager.complete_job_transcript`. Returns the resources used, as `transcribe_job` does.
+    """
+    reset_peak_rss()
+    media_manager = MediaManager()
+    try:
+        for job_id in job_ids:
+            media_manager.start_job_transcript(job_id)
+        settings = json.loads(media_manager.get_job(job_ids[0]).settings)
+        # Clips are short, so the long file settings don't apply & neither does the voice activity filter, as each
+        # clip is padded to a whole whisper window anyway
+        for key in ("long_file_threshold", "chunk_length", "chunk_overlap", "chunk_workers", "vad_filter"):
+            settings.pop(key, None)
+        audios = [np.array(load_audio(media_manager.get_job_media(job_id).filepath)) for job_id in job_ids]
+        for job_id, audio in zip(job_ids, audios):
+            media_manager.set_job_duration(job_id, len(audio) / SAMPLE_RATE)
+
+        transcripts = transcribe_batch(audios, **settings)
+        for job_id, audio, transcript in zip(job_ids, audios, transcripts):
+            media_manager.save_job_window(job_id, transcript, len(audio) / SAMPLE_RATE)
+            media_manager.index_job_transcript(job_id)
+    finally:
+        media_manager.session.close()
+
+    return {"threads": torch.get_num_threads(), "peak_rss_mb": peak_rss_mb()}
+
+
+def _transcribe_job(
+    media_manager: "MediaManager",
+    job_id: str,
+    audio_path: str,
+    start: float,
+    whisper_model: str,
+    long_file_threshold: Optional[float] = None,
+    chunk_length: float = 600.0,
+    chunk_overlap: float = 5.0,
+    chunk_workers: int = 1,
+    quantize: bool = False,
+    asr_backend: str = DEFAULT_ASR_BACKEND,
+    vad_filter: bool = False,
+    **whisper_args,
+):
+    """Transcribe & save the audio of a job from `start` seconds on, with the job's settings
+
+    Returns the threads used & the peak memory (in MB) of the chunk processes of the long file mode (0 without them).
+    """
+    audio = load_audio(audio_path)
+    media_manager.set_job_duration(job_id, len(audio) / SAMPLE_RATE)
+    # The job may have been interrupted after saving its last window
+    if start * SAMPLE_RATE >= len(audio):
+        return torch.get_num_threads(), 0.0
+    if use_long_file_mode(len(audio), long_file_threshold, chunk_workers):
+        files_dir = media_manager.media_files_dir(media_manager.get_job_media(job_id))
+        transcript = transcribe_long(
+            audio_path,
+            whisper_model,
+            chunk_length,
+            chunk_overlap,
+            chunk_workers,
+            checkpoint_dir=job_checkpoint_dir(files_dir, job_id),
+            quantize=quantize,
+            asr_backend=asr_backend,
+            vad_filter=vad_filter,
+            **_whisper_decode_args(whisper_args),
+        )
+        media_manager.save_job_window(job_id, transcript, len(audio) / SAMPLE_RATE)
+        # See `transcribe_long`
+        return chunk_workers * max(1, os.cpu_count() // chunk_workers), transcript["peak_rss_mb"]
+
+    windows = transcribe_windows(
+        audio_path,
+        whisper_model,
+        TRANSCRIBE_CHECKPOINT_INTERVAL,
+        start,
+        quantize,
+        asr_backend,
+        vad_filter,
+        **whisper_args,
+    )
+    for end, transcript in windows:
+        media_manager.save_job_window(job_id, transcript, end)
+    return torch.get_num_threads(), 0.0
+
+
+# Trash collection
+# ----------------
+_trash_collector: Optional[threading.Thread] = None
+_trash_collector_lock = threading.Lock()
+
+
+def start_trash_collector(interval: float = TRASH_COLLECT_INTERVAL) -> threading.Thread:
+    """Remove the files of deleted media objects (see `MediaManager.empty_trash`) every `interval` seconds in a
+    background thread, which is started once per process
+    """
+    global _trash_collector
+
+    def collect():
+        media_manager = MediaManager()
+        while True:
+            try:
+                while media_manager.empty_trash():
+                    pass
+            except Exception:
+                traceback.print_exc()
+                media_manager.session.rollback()
+            time.sleep(interval)
+
+    with _trash_collector_lock:
+        if _trash_collector is None:
+            _trash_collector = threading.Thread(target=collect, name="trash-collector", daemon=True)
+            _trash_collector.start()
+    return _trash_collector
@@ -6,10 +6,16 @@ from datetime import datetime
 from typing import List, Optional
 
 from config import DATA_DIR, DEBUG
-from sqlalchemy import ForeignKey, MetaData, create_engine
+from sqlalchemy import ForeignKey, Index, MetaData, column, create_engine, event, func, inspect, select, table, text
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
+def timestamp() -> str:
+    "Current time as a timezone aware isoformatted string (local timezone)"
+    return datetime.now().astimezone().isoformat()
+
+
 # This is a slightly augmented version of SQL model that adds some common fields
 # that are used across all models
 # Also, to keep things simple, only sqlite native types are used
@@ -18,8 +24,8 @@ class Base(DeclarativeBase):
     id: Mapped[str] = mapped_column(default=lambda: str(uuid.uuid4()), primary_key=True)
 
     # All timestamps are timezone aware isoformatted strings (local timezone by default)
-    created: Mapped[str] = mapped_column(default=lambda: datetime.now().astimezone().isoformat(), nullable=False)
-    updated: Mapped[str] = mapped_column(default=lambda: datetime.now().astimezone().isoformat(), nullable=False)
+    created: Mapped[str] = mapped_column(default=timestamp, nullable=False)
+    updated: Mapped[str] = mapped_column(default=timestamp, nullable=False)
 
 
 # Models & Schemas
@@ -28,24 +34,58 @@ class Base(DeclarativeBase):
 # like transcripts & derived data from them.
 class Media(Base):
     __tablename__ = "media"
+    # Listings are sorted (& paginated) by creation date
+    __table_args__ = (Index("ix_media_created_id", "created", "id"),)
 
     # Source type is a string and is, as of now, either
     source_type: Mapped[str]
     source_name: Mapped[str]
     source_link: Mapped[Optional[str]]
 
-    # Full path of where the audio is locally stored
-    filepath: Mapped[str]
+    # The stored audio, shared by all the media objects with identical audio (see `Blob`). Media added before audio
+    # was stored by content have no blob & a file of their own
+    blob_id: Mapped[Optional[str]] = mapped_column(ForeignKey("blob.id"))
+    blob: Mapped[Optional["Blob"]] = relationship(lazy="joined")
+    # Path of the audio file of media without a blob (also set for the others, as older databases require it)
+    _filepath: Mapped[str] = mapped_column("filepath")
+    # SHA-256 of the stored file, to find identical audio
+    audio_hash: Mapped[Optional[str]] = mapped_column(index=True)
 
     # Additional metadata
     duration: Mapped[Optional[float]]
+    # Size (in bytes) of the file as it was downloaded or uploaded & of the files kept on disk for it (see
+    # `config.STORAGE_POLICY`)
+    original_size: Mapped[Optional[int]]
+    stored_size: Mapped[Optional[int]]
+    # Collection (i.e. folder) the media object is filed in, if any
+    collection: Mapped[Optional[str]] = mapped_column(index=True)
 
-    # Flag to indicate if the audio has been transcribed
-    transcript: Mapped["Transcript"] = relationship(back_populates="media", uselist=False, cascade="all, delete-orphan")
+    # A media object can be transcribed several times (e.g. with different models), one of which is active & used
+    # everywhere the media is listed or searched
+    transcripts: Mapped[List["Transcript"]] = relationship(
+        back_populates="media", order_by="Transcript.created", cascade="all, delete-orphan"
+    )
+    transcript: Mapped[Optional["Transcript"]] = relationship(
+        primaryjoin="and_(Media.id == Transcript.media_id, Transcript.active == True)", viewonly=True, uselist=False
+    )
     segments: Mapped[List["Segment"]] = relationship(
         back_populates="media", order_by="Segment.number", cascade="all, delete-orphan"
     )
 
+    @hybrid_property
+    def filepath(self) -> str:
+        "Full path of where the audio is locally stored"
+        return self.blob.path if self.blob is not None else self._filepath
+
+    @filepath.inplace.setter
+    def _filepath_setter(self, filepath: str):
+        self._filepath = filepath
+
+    @filepath.inplace.expression
+    @classmethod
+    def _filepath_expression(cls):
+        return func.coalesce(select(Blob.path).where(Blob.id == cls.blob_id).scalar_subquery(), cls._filepath)
+
 
 class Transcript(Base):
     """A transcript is the full text of an audio file's transcription"""
@@ -53,23 +93,42 @@ class Transcript(Base):
     __tablename__ = "transcript"
 
     # The media object that this transcript is for
-    media_id: Mapped[str] = mapped_column(ForeignKey("media.id", ondelete="CASCADE"), nullable=False)
-    media: Mapped["Media"] = relationship(back_populates="transcript")
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id", ondelete="CASCADE"), nullable=False, index=True)
+    media: Mapped["Media"] = relationship(back_populates="transcripts")
+    segments: Mapped[List["Segment"]] = relationship(
+        back_populates="transcript", order_by="Segment.number", cascade="all, delete-orphan"
+    )
 
     # The transcript
     text: Mapped[str]
     language: Mapped[str]
     generated_by: Mapped[str]
+    # JSON encoded whisper settings used & their hash (along with the model), to reuse the transcript for identical
+    # audio
+    settings: Mapped[Optional[str]]
+    settings_hash: Mapped[Optional[str]]
+    # Whether this is the transcript in use for the media object
+    active: Mapped[Optional[bool]]
+    # Set while the transcript is being written by a job (its segments are saved as they are decoded)
+    partial: Mapped[Optional[bool]]
 
 
 class Segment(Base):
     """A segment is a transcription of a specific audio segment within the file"""
 
     __tablename__ = "segment"
+    # Segments are listed (& paginated) in order within each media object & read in order within each transcript
+    __table_args__ = (
+        Index("ix_segment_media_id_number", "media_id", "number"),
+        Index("ix_segment_transcript_id_number", "transcript_id", "number"),
+    )
 
     # The media object that this transcript is for
     media_id: Mapped[str] = mapped_column(ForeignKey("media.id", ondelete="CASCADE"), nullable=False)
     media: Mapped["Media"] = relationship(back_populates="segments")
+    # The transcript this segment is part of
+    transcript_id: Mapped[Optional[str]] = mapped_column(ForeignKey("transcript.id", ondelete="CASCADE"))
+    transcript: Mapped[Optional["Transcript"]] = relationship(back_populates="segments")
 
     # Segment text
     number: Mapped[int]
@@ -85,6 +144,106 @@ class Segment(Base):
     no_speech_prob: Mapped[float]
 
 
+class Job(Base):
+    """A job is a queued request to download and transcribe a single source, processed by a worker"""
+
+    __tablename__ = "job"
+
+    # What to ingest: a YouTube URL or the path of an upload that has already been saved to the media directory
+    source_type: Mapped[str]
+    source: Mapped[str]
+    source_name: Mapped[Optional[str]]
+    # SHA-256 of uploads (computed while they are saved)
+    audio_hash: Mapped[Optional[str]]
+
+    # JSON encoded whisper settings the job was queued with
+    settings: Mapped[str]
+
+    # One of queued, running, done or failed
+    status: Mapped[str] = mapped_column(default="queued", index=True)
+    error: Mapped[Optional[str]]
+    worker: Mapped[Optional[str]]
+    started: Mapped[Optional[str]]
+    finished: Mapped[Optional[str]]
+
+    # Wall clock time (in seconds) spent in each stage of the job
+    download_time: Mapped[Optional[float]]
+    transcribe_time: Mapped[Optional[float]]
+    save_time: Mapped[Optional[float]]
+
+    # The media object created by this job (once it has been downloaded)
+    media_id: Mapped[Optional[str]] = mapped_column(ForeignKey("media.id", ondelete="SET NULL"))
+    # The transcript the job saves segments to as they are decoded & the offset (in seconds) of the audio that has
+    # been transcribed & saved so far, which an interrupted job resumes from
+    transcript_id: Mapped[Optional[str]] = mapped_column(ForeignKey("transcript.id", ondelete="SET NULL"))
+    checkpoint: Mapped[Optional[float]]
+    # Seconds of audio that the voice activity filter left out of transcription (see `core.transcribe_speech`)
+    skipped_duration: Mapped[Optional[float]]
+
+
+class TranscriptionMetric(Base):
+    """How long a transcription took & what it used, to compare models & plan capacity"""
+
+    __tablename__ = "transcription_metric"
+
+    # What was transcribed
+    job_id: Mapped[Optional[str]] = mapped_column(ForeignKey("job.id", ondelete="SET NULL"))
+    media_id: Mapped[Optional[str]] = mapped_column(ForeignKey("media.id", ondelete="SET NULL"))
+    transcript_id: Mapped[Optional[str]] = mapped_column(ForeignKey("transcript.id", ondelete="SET NULL"))
+    # Engine that ran the model (see asr.py), NULL for metrics recorded before there were several
+    asr_backend: Mapped[Optional[str]]
+    whisper_model: Mapped[str] = mapped_column(index=True)
+
+    # Length of the audio & wall clock time of the transcription (in seconds), and their ratio (below 1 is faster
+    # than real time)
+    audio_duration: Mapped[Optional[float]]
+    wall_time: Mapped[float]
+    real_time_factor: Mapped[Optional[float]]
+    # CPU threads used by whisper & peak resident memory (in MB) of the transcription process(es) during the
+    # transcription
+    threads: Mapped[Optional[int]]
+    peak_rss_mb: Mapped[Optional[float]]
+    # Number of segments that had to be decoded again at a higher temperature
+    fallback_count: Mapped[Optional[int]]
+    # Seconds of audio that the voice activity filter left out of transcription
+    skipped_duration: Mapped[Optional[float]]
+
+
+class Blob(Base):
+    """Audio stored by content, shared by all the media objects with identical audio
+
+    Each blob has a directory named after the hash of the audio & sharded by its first characters (see
+    `core.blob_dir`), so identical media take no extra space & no directory grows too large. The files of a blob are
+    removed once no media object uses it anymore (see `core.MediaManager.empty_trash`).
+    """
+
+    __tablename__ = "blob"
+
+    # SHA-256 of the audio as downloaded or uploaded (the `audio_hash` of its media)
+    hash: Mapped[str] = mapped_column(unique=True)
+    # Full path of the stored audio file (see `config.STORAGE_POLICY`) & bytes used by the stored files
+    path: Mapped[str]
+    size: Mapped[Optional[int]]
+    # Number of media objects using the blob
+    refcount: Mapped[int] = mapped_column(default=0)
+
+
+class Trash(Base):
+    """A file or directory of deleted media to remove from disk
+
+    Deletes only touch the database & leave their files here, so that they are removed in the background (see
+    `core.MediaManager.empty_trash`) rather than while the caller waits.
+    """
+
+    __tablename__ = "trash"
+
+    path: Mapped[str]
+    # The media object the files belonged to, whose segment vectors are removed along with them
+    media_id: Mapped[Optional[str]]
+    # The blob the files belong to, if they are those of a blob (which are kept if media use it again in the meantime)
+    blob_id: Mapped[Optional[str]]
+
+
 # Database config
 # ----------------------
 DATABASE_URL = f"sqlite:///{DATA_DIR}/db.sqlite3"
@@ -93,5 +252,149 @@ DATABASE_URL = f"sqlite:///{DATA_DIR}/db.sqlite3"
 # Create database engine
 ENGINE = create_engine(DATABASE_URL, echo=True) if DEBUG else create_engine(DATABASE_URL)
 
+
+def add_missing_columns(engine):
+    """Add columns (& their indexes) that were added to the models after their table was created
+
+    `create_all` only creates missing tables, so this keeps existing databases usable as models evolve.
+    NOTE: New columns on existing tables must therefore be nullable (or have a server default).
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for model_table in Base.metadata.sorted_tables:
+            existing_columns = {info["name"] for info in inspector.get_columns(model_table.name)}
+            for model_column in model_table.columns:
+                if model_column.name not in existing_columns:
+                    column_type = model_column.type.compile(engine.dialect)
+                    connection.execute(
+                        text(f"ALTER TABLE {model_table.name} ADD COLUMN {model_column.name} {column_type}")
+                    )
+            for index in model_table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def backfill_transcripts(engine):
+    "Link segments created before media objects could have several transcripts to their (then only) transcript"
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE transcript SET active = 1 WHERE active IS NULL"))
+        connection.execute(
+            text(
+                """UPDATE segment SET transcript_id = (
+                    SELECT transcript.id FROM transcript WHERE transcript.media_id = segment.media_id
+                ) WHERE transcript_id IS NULL"""
+            )
+        )
+
+
+def detach_deleted_media_jobs(engine):
+    "Clear the media & transcripts of jobs whose media was deleted before deletes detached its jobs"
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                """UPDATE job SET media_id = NULL, transcript_id = NULL, checkpoint = NULL, skipped_duration = NULL
+                WHERE media_id IS NOT NULL AND media_id NOT IN (SELECT id FROM media)"""
+            )
+        )
+
+
+# Query instrumentation
+# ----------------------
+class QueryCounter:
+    """Counts the SQL statements executed on an engine while in use, e.g. to check that a listing doesn't issue
+    a query per row (see benchmarks/bench_query_count.py)
+
+        with QueryCounter() as counter:
+            media_manager.get_list(limit=100)
+        assert counter.count == 1
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or ENGINE
+        self.count = 0
+        self.statements = []
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+
+
+# Full-text search
+# ----------------------
+# External content FTS5 tables index the text of segments & transcripts (by rowid) without storing it twice,
+# and triggers keep them in sync with every insert, update & delete
+# NOTE: These tables have text primary keys, so their rowid is implicit & VACUUM may renumber it, which would leave the
+# indexes pointing at the wrong rows. Compact the database with `vacuum`, which rebuilds the indexes, rather than
+# running VACUUM directly
+FTS_TABLES = ["segment", "transcript"]
+segment_fts = table("segment_fts", column("rowid"), column("rank"))
+transcript_fts = table("transcript_fts", column("rowid"), column("rank"))
+
+
+def create_fts_tables(engine):
+    "Create the full-text search tables & their triggers, indexing any existing rows"
+    with engine.begin() as connection:
+        for source in FTS_TABLES:
+            fts = f"{source}_fts"
+            if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": fts}).first():
+                continue
+
+            connection.execute(
+                text(
+                    f"CREATE VIRTUAL TABLE {fts} USING fts5(text, content='{source}', content_rowid='rowid', "
+                    "tokenize='unicode61 remove_diacritics 2')"
+                )
+            )
+            connection.execute(
+                text(
+                    f"""CREATE TRIGGER {fts}_insert AFTER INSERT ON {source} BEGIN
+                    INSERT INTO {fts}(rowid, text) VALUES (new.rowid, new.text);
+                    END"""
+                )
+            )
+            connection.execute(
+                text(
+                    f"""CREATE TRIGGER {fts}_delete AFTER DELETE ON {source} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.rowid, old.text);
+                    END"""
+                )
+            )
+            connection.execute(
+                text(
+                    f"""CREATE TRIGGER {fts}_update AFTER UPDATE OF text ON {source} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.rowid, old.text);
+                    INSERT INTO {fts}(rowid, text) VALUES (new.rowid, new.text);
+                    END"""
+                )
+            )
+            # Index the rows that existed before the table was created
+            connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+def vacuum(engine):
+    """Compact the database file & rebuild the full-text indexes, whose rowids VACUUM may have renumbered
+
+    NOTE: Search results are paginated by rowid (see `core.MediaManager.get_segments`), so pages of a search that
+    was open while vacuuming may skip or repeat results.
+    """
+    with engine.connect() as connection:
+        # VACUUM can't run inside a transaction
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    with engine.begin() as connection:
+        for source in FTS_TABLES:
+            fts = f"{source}_fts"
+            connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
 # Create all tables
 Base.metadata.create_all(ENGINE)
+add_missing_columns(ENGINE)
+backfill_transcripts(ENGINE)
+detach_deleted_media_jobs(ENGINE)
+create_fts_tables(ENGINE)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import json
 from datetime import datetime
 from pathlib import Path
 import streamlit as st
 from config import get_page_config, get_whisper_settings, save_whisper_settings
-from core import MediaManager
+from core import EXPORT_FORMATS, MediaManager, start_trash_collector
 
 # st.set_page_config(**get_page_config())
 
@@ -25,9 +26,16 @@ if "whisper_params" not in st.session_state:
 if "media_manager" not in st.session_state:
     st.session_state.media_manager = MediaManager()
 
+# Media objects selected in the list for bulk actions
+if "selected_media_ids" not in st.session_state:
+    st.session_state.selected_media_ids = set()
+
 # Alias for session state media manager
 media_manager = st.session_state.media_manager
 
+# Files of deleted media are removed in the background
+start_trash_collector()
+
 
 # Helper functions
 # ----------------
@@ -38,6 +46,107 @@ def get_formatted_date(date_str: str) -> str:
     return f"{time}, {date}"
 
 
+def get_page_cursor(listing: str, filters: dict):
+    "Cursor of the current page of a listing (None for the first page), going back to the first page on new filters"
+    filters_signature = json.dumps(filters, sort_keys=True)
+    if st.session_state.get(f"{listing}_filters") != filters_signature:
+        st.session_state[f"{listing}_filters"] = filters_signature
+        st.session_state[f"{listing}_cursors"] = [None]
+    return st.session_state[f"{listing}_cursors"][-1]
+
+
+def render_pagination(listing: str, items: list, limit: int):
+    "Render previous & next page buttons for a listing"
+    cursors = st.session_state[f"{listing}_cursors"]
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if len(cursors) > 1 and st.button("◀️ &nbsp; Previous page", key=f"{listing}-previous"):
+            cursors.pop()
+            st.experimental_rerun()
+    with next_col:
+        # A full page means that there may be more items
+        if len(items) == limit and st.button("Next page &nbsp; ▶️", key=f"{listing}-next"):
+            cursors.append(items[-1]["cursor"])
+            st.experimental_rerun()
+
+
+def render_segment(segment: dict, key_prefix: str):
+    "Render a segment search result along with its media"
+    # Create 2 columns
+    meta_col, media_col = st.columns([2, 1], gap="large")
+
+    with meta_col:
+        # Add a meta caption
+        st.markdown(
+            f"""<h4><i>"{segment["snippet"] or segment["text"]}</i>" - <code>[{int(segment['start'])}s - {int(segment['end'])}s]</code></h4>""",
+            unsafe_allow_html=True,
+        )
+
+        # Add a meta caption
+        media = segment["media"]
+        source_type = "YouTube" if media["source_type"] == "youtube" else "uploaded"
+        st.markdown(
+            f"""
+            <i>Source</i>: <b>{media['source_name']}</b> ({source_type})<br/>
+            <i>Added</i>: {get_formatted_date(media["created"])}<br/>
+            <i>Generated by</i>: {media["generated_by"]}<br/>
+        """,
+            unsafe_allow_html=True,
+        )
+        if "score" in segment:
+            st.caption(f"Similarity: {segment['score']:.2f}")
+
+        if st.button("🧐 Details", key=f"{key_prefix}-{segment['number']}-{segment['media']['id']}"):
+            st.session_state.list_mode = False
+            st.session_state.selected_media = segment["media"]["id"]
+            st.session_state.selected_transcript = None
+            st.experimental_rerun()
+
+    with media_col:
+        # NOTE: Adding video for youtube makes the list slow & ugly and is ignored here
+        st.audio(segment["media"]["filepath"], start_time=int(segment["start"]))
+
+    st.write("---")
+
+
+def render_live_job(job_id: str):
+    "Render the transcript of a job as it is decoded, along with its progress, until the job is done"
+    header_col, close_col = st.columns([4, 1])
+    with header_col:
+        st.write("## Live transcript")
+    with close_col:
+        if st.button("✖️ Close", key="close-live-job"):
+            st.session_state.live_job = None
+            st.experimental_rerun()
+    progress_bar = st.progress(0.0)
+    progress_caption = st.empty()
+    segments_container = st.container()
+
+    for update in media_manager.stream_job(job_id):
+        if update["duration"]:
+            progress_bar.progress(min(1.0, update["transcribed"] / update["duration"]))
+            progress_caption.caption(
+                f"""{update["status"].capitalize()} · {int(update["transcribed"])}s of {int(update["duration"])}s"""
+            )
+        else:
+            progress_caption.caption(f"""{update["status"].capitalize()} · waiting for the audio""")
+        with segments_container:
+            for segment in update["segments"]:
+                st.markdown(f"""`[{int(segment["start"])}s - {int(segment["end"])}s]` {segment["text"]}""")
+
+    if update["status"] == "failed":
+        st.error(update["error"].strip().splitlines()[-1])
+    else:
+        progress_bar.progress(1.0)
+        if st.button("🧐 Details", key="live-job-details"):
+            st.session_state.list_mode = False
+            st.session_state.selected_media = update["media_id"]
+            st.session_state.selected_transcript = None
+            st.session_state.live_job = None
+            st.experimental_rerun()
+    st.write("---")
+
+
 def main():
     # Add view
     # ---------
@@ -77,18 +186,59 @@ def main():
             st.session_state.whisper_params["task"] = task
 
             if source:
-                media_manager.add(
-                    source=source,
-                    source_type=source_type,
-                    **st.session_state.whisper_params,
-                )
-                # Render success message
-                st.success("Media downloading & processing in progress.")
+                try:
+                    job_ids = media_manager.add(
+                        source=source,
+                        source_type=source_type,
+                        **st.session_state.whisper_params,
+                    )
+                except ValueError as e:
+                    st.error(str(e))
+                    st.stop()
+                # Render success message & follow the first item as it is transcribed
+                st.success(f"{len(job_ids)} item(s) queued for download & processing.")
+                # Playlists may have no entries
+                if job_ids:
+                    st.session_state.live_job = job_ids[0]
 
             # Set list mode to true
             st.session_state.list_mode = True
             st.experimental_rerun()
 
+    # Job queue
+    # ---------
+    with st.sidebar.expander("⏳ &nbsp; Jobs", expanded=False):
+        jobs = media_manager.get_jobs(limit=20)
+        if not jobs:
+            st.write("No jobs yet. Jobs are processed by `python app/worker.py`.")
+
+        for job in jobs:
+            status_icon = {"queued": "🕒", "running": "⚙️", "done": "✅", "failed": "❌"}[job["status"]]
+            st.markdown(
+                f"""{status_icon} <b>{job["source_name"] or job["source"]}</b><br/>
+                <i>Status</i>: {job["status"]}<br/>
+                <i>Added</i>: {get_formatted_date(job["created"])}<br/>
+            """,
+                unsafe_allow_html=True,
+            )
+            if job["status"] == "done":
+                st.caption(
+                    f"""Download {job["download_time"] or 0:.1f}s · Transcribe {job["transcribe_time"]:.1f}s · """
+                    f"""Save {job["save_time"]:.1f}s"""
+                )
+            if job["status"] in ("queued", "running"):
+                if st.button("📡 Follow", key=f"follow-{job['id']}"):
+                    st.session_state.live_job = job["id"]
+                    st.experimental_rerun()
+            if job["status"] == "failed":
+                st.code(job["error"].strip().splitlines()[-1])
+                if job["retryable"] and st.button("🔁 Retry", key=f"retry-{job['id']}"):
+                    media_manager.retry_job(job["id"])
+                    st.experimental_rerun()
+
+        if st.button("🔄 Refresh", key="refresh-jobs"):
+            st.experimental_rerun()
+
     # Filters for media
     # -----------------
     with st.sidebar.expander("🔎 &nbsp; Search", expanded=st.session_state.list_mode):
@@ -110,6 +260,11 @@ def main():
         if media_type != "All":
             filters["source_type"] = media_type.lower()
 
+        # Add a collection filter
+        collection = st.selectbox("Collection", options=["All", *media_manager.get_collections()], index=0)
+        if collection != "All":
+            filters["collection"] = collection
+
         # Add search filter
         search_by_name = st.text_input("Search (by title)")
         if search_by_name:
@@ -120,28 +275,66 @@ def main():
         if search_by_transcript:
             filters["search_by_transcript"] = search_by_transcript
 
+        # Add semantic search (not a filter, as it ranks segments by similarity instead)
+        semantic_query = st.text_input("Search (by meaning)")
+
         # Number of items per page
         limit = st.number_input("Items per page", min_value=1, max_value=100, value=10)
         filters["limit"] = limit
 
+    # Bulk actions on the media objects selected in the list
+    # ------------------------------------------------------
+    selected_media_ids = st.session_state.selected_media_ids
+    if st.session_state.list_mode and selected_media_ids:
+        with st.sidebar.expander(f"☑️ &nbsp; {len(selected_media_ids)} selected", expanded=True):
+            target_collection = st.text_input("Collection", help="Leave empty to remove from their collection")
+            if st.button("📁 Move", key="move-selected"):
+                media_manager.move_many(list(selected_media_ids), target_collection)
+                selected_media_ids.clear()
+                st.experimental_rerun()
+
+            if st.button("🔁 Transcribe again", key="retranscribe-selected"):
+                whisper_args = dict(st.session_state.whisper_params)
+                whisper_model = whisper_args.pop("whisper_model")
+                job_ids = media_manager.retranscribe_many(list(selected_media_ids), whisper_model, **whisper_args)
+                selected_media_ids.clear()
+                st.success(f"{len(job_ids)} item(s) queued with the current settings.")
+
+            if st.button("🗑️ Delete", key="delete-selected"):
+                media_manager.delete_many(list(selected_media_ids))
+                selected_media_ids.clear()
+                st.experimental_rerun()
+
+            if st.button("✖️ Clear selection", key="clear-selected"):
+                selected_media_ids.clear()
+                st.experimental_rerun()
+
+    # Live transcript of a job, rendered above the list or detail view once they are shown
+    live_container = st.container()
 
     # List view
     # ---------
     if st.session_state.list_mode:
         # # Reset detail view session state
         st.session_state.selected_media_offset = 0
+        st.session_state.selected_transcript = None
 
         st.write("## Media Library")
 
-        if "search_by_transcript" in filters:
+        if semantic_query and "search_by_transcript" in filters:
+            # Create tabs for search by meaning, by file & by transcript
+            semantic_tab, segment_tab, file_tab = st.tabs(["Similar segments", "Segments", "Files"])
+        elif semantic_query:
+            semantic_tab, file_tab = st.tabs(["Similar segments", "Files"])
+        elif "search_by_transcript" in filters:
             # Create tabs for search by file & by transcript
             segment_tab, file_tab = st.tabs(["Segments", "Files"])
         else:
             file_tab = st.container()
 
         with file_tab:
-            # Get all media with the filters
-            media_objs = media_manager.get_list(**filters)
+            # Get the current page of media with the filters
+            media_objs = media_manager.get_list(cursor=get_page_cursor("files", filters), **filters)
 
             # If no media objects are found
             if not media_objs:
@@ -158,6 +351,9 @@ def main():
                 with meta_col:
                     # Add a meta caption
                     st.write(f"#### {media['source_name']}")
+                    # Show where the search matched the transcript
+                    if media["snippet"]:
+                        st.markdown(f"""<i>"…{media["snippet"]}…"</i>""", unsafe_allow_html=True)
 
                     source_type = "YouTube" if media["source_type"] == "youtube" else "upload"
                     st.markdown(
@@ -165,10 +361,22 @@ def main():
                         <i>Source</i>: {source_type}<br/>
                         <i>Added</i>: {get_formatted_date(media["created"])}<br/>
                         <i>Generated by</i>: {media["generated_by"]}<br/>
+                        <i>Collection</i>: {media["collection"] or "-"}<br/>
                     """,
                         unsafe_allow_html=True,
                     )
 
+                    selected = st.checkbox(
+                        "Select", value=media["id"] in selected_media_ids, key=f"select-{media['id']}"
+                    )
+                    if selected != (media["id"] in selected_media_ids):
+                        if selected:
+                            selected_media_ids.add(media["id"])
+                        else:
+                            selected_media_ids.discard(media["id"])
+                        # Show the bulk actions for the new selection
+                        st.experimental_rerun()
+
                     if st.button("🧐 Details", key=f"detail-{media['id']}"):
                         st.session_state.list_mode = False
                         st.session_state.selected_media = media["id"]
@@ -187,10 +395,24 @@ def main():
 
                 st.write("---")
 
+            render_pagination("files", media_objs, filters["limit"])
+
+        if semantic_query:
+            with semantic_tab:
+                # Get the segments closest in meaning to the query
+                segment_objs = media_manager.semantic_search(semantic_query, k=filters["limit"], **filters)
+
+                # If no segments are found
+                if not segment_objs:
+                    st.warning("No segments found. Add some media or update filters and try again.")
+
+                for segment in segment_objs:
+                    render_segment(segment, key_prefix="semantic")
+
         if "search_by_transcript" in filters:
             with segment_tab:
-                # Get all media with the filters
-                segment_objs = media_manager.get_segments(**filters)
+                # Get the current page of segments with the filters
+                segment_objs = media_manager.get_segments(cursor=get_page_cursor("segments", filters), **filters)
 
                 # If no media objects are found
                 if not segment_objs:
@@ -198,44 +420,17 @@ def main():
 
                 # Render media objects
                 for segment in segment_objs:
-                    # Create 2 columns
-                    meta_col, media_col = st.columns([2, 1], gap="large")
-
-                    with meta_col:
-                        # Add a meta caption
-                        st.markdown(
-                            f"""<h4><i>"{segment["text"]}</i>" - <code>[{int(segment['start'])}s - {int(segment['end'])}s]</code></h4>""",
-                            unsafe_allow_html=True,
-                        )
-
-                        # Add a meta caption
-                        source_type = "YouTube" if media["source_type"] == "youtube" else "uploaded"
-                        st.markdown(
-                            f"""
-                            <i>Source</i>: <b>{media['source_name']}</b> ({source_type})<br/>
-                            <i>Added</i>: {get_formatted_date(media["created"])}<br/>
-                            <i>Generated by</i>: {media["generated_by"]}<br/>
-                        """,
-                            unsafe_allow_html=True,
-                        )
-
-                        if st.button("🧐 Details", key=f"segment-{segment['number']}-{segment['media']['id']}"):
-                            st.session_state.list_mode = False
-                            st.session_state.selected_media = segment["media"]["id"]
-                            st.experimental_rerun()
-
-                    with media_col:
-                        # NOTE: Adding video for youtube makes the list slow & ugly and is ignored here
-                        st.audio(segment["media"]["filepath"], start_time=int(segment["start"]))
-
-                    st.write("---")
+                    render_segment(segment, key_prefix="segment")
 
+                render_pagination("segments", segment_objs, filters["limit"])
 
     # Detail view
     # -----------
     else:
         # Get the selected media object
-        media = media_manager.get_detail(media_id=st.session_state.selected_media)
+        media = media_manager.get_detail(
+            media_id=st.session_state.selected_media, transcript_id=st.session_state.get("selected_transcript")
+        )
 
         # Render mini nav
         back_col, del_col = st.sidebar.columns(2)
@@ -252,6 +447,48 @@ def main():
 
         st.sidebar.write(f"""### {media["source_name"]}""")
 
+        # Switch between the transcripts of the media object or transcribe it again with other settings
+        with st.sidebar.expander("🔁 &nbsp; Transcripts", expanded=False):
+            transcripts = media_manager.get_transcripts(media["id"])
+            transcript_labels = {
+                transcript["id"]: f"""{transcript["generated_by"]} · {get_formatted_date(transcript["created"])}"""
+                + (" (active)" if transcript["active"] else "")
+                for transcript in transcripts
+            }
+            transcript_ids = list(transcript_labels)
+            selected_transcript = st.selectbox(
+                "Transcript",
+                options=transcript_ids,
+                index=transcript_ids.index(media["transcript_id"]),
+                format_func=transcript_labels.get,
+            )
+            if selected_transcript != media["transcript_id"]:
+                st.session_state.selected_transcript = selected_transcript
+                st.experimental_rerun()
+            if not next(t["active"] for t in transcripts if t["id"] == selected_transcript):
+                if st.button("✔️ Make active", key=f"activate-{selected_transcript}"):
+                    media_manager.set_active_transcript(media["id"], selected_transcript)
+                    st.experimental_rerun()
+
+            with st.form("retranscribe_form"):
+                model_options = ["tiny", "base", "small", "medium", "large"]
+                whisper_model = st.selectbox(
+                    "Model",
+                    options=model_options,
+                    index=model_options.index(st.session_state.whisper_params["whisper_model"]),
+                )
+                retranscribe = st.form_submit_button(label="Transcribe again")
+            if retranscribe:
+                whisper_args = {**st.session_state.whisper_params}
+                whisper_args.pop("whisper_model")
+                job_id = media_manager.retranscribe(media["id"], whisper_model, **whisper_args)
+                if job_id is None:
+                    # Already transcribed with these settings, so that transcript was made active instead
+                    st.session_state.selected_transcript = None
+                    st.experimental_rerun()
+                st.success("Queued for transcription. The new transcript becomes active once it is done.")
+                st.session_state.live_job = job_id
+
         # Render the media. Use both audio & video for youtube
         if media["source_type"] == "youtube":
             st.sidebar.audio(media["filepath"], start_time=st.session_state.selected_media_offset)
@@ -270,11 +507,29 @@ def main():
                 <i>Added</i>: {get_formatted_date(media["created"])}<br/>
                 <i>Generated by</i>: {media["generated_by"]}<br/>
                 <i>Audio directory</i>: `{Path(media["filepath"]).parent}`<br/>
-                <i>Audio path</i>: `{media["filepath"]}`<br/>
-                <i>Transcript path</i>: `{Path(media["filepath"]).parent / "transcript"}[(.srt, .vtt, .json, .txt, 
-                .tsv)]`<br/> """,
+                <i>Audio path</i>: `{media["filepath"]}`<br/> """,
                 unsafe_allow_html=True,
             )
+            if media["original_size"]:
+                st.caption(
+                    f"""Stored in {media["stored_size"] / 2**20:.1f} MB, downloaded as """
+                    f"""{media["original_size"] / 2**20:.1f} MB """
+                    f"""({1 - media["stored_size"] / media["original_size"]:.0%} saved)"""
+                )
+
+        with st.expander("💾 &nbsp; Export Transcript"):
+            # Files are only generated (& cached) on request, not every time the transcript is shown
+            output_format = st.selectbox("Format", options=EXPORT_FORMATS)
+            export = (media["transcript_id"], output_format)
+            if st.button("📦 Prepare export", key=f"export-{media['transcript_id']}-{output_format}"):
+                st.session_state.prepared_export = export
+            if st.session_state.get("prepared_export") == export:
+                export_path = media_manager.export_transcript(*export)
+                st.download_button(
+                    f"Download .{output_format}",
+                    data=export_path.read_bytes(),
+                    file_name=f"""{media["source_name"]}.{output_format}""",
+                )
 
         with st.expander("📝 &nbsp; Full Transcript"):
             st.markdown(media["transcript"])
@@ -297,6 +552,11 @@ def main():
             with text_col:
                 st.write(f'##### `{segment["text"]}`')
 
+    # Follow the job last (it runs until the job is done) so that the rest of the page is usable in the meantime
+    if st.session_state.get("live_job"):
+        with live_container:
+            render_live_job(st.session_state.live_job)
+
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,9 @@
 # coding: utf-8
 
 import streamlit as st
+from asr import ASR_BACKENDS
 from config import WHISPER_SETTINGS_FILE, get_page_config, get_whisper_settings, save_whisper_settings
+from core import MediaManager
 
 st.set_page_config(**get_page_config(layout="centered"))
 
@@ -13,6 +15,9 @@ st.set_page_config(**get_page_config(layout="centered"))
 if "whisper_params" not in st.session_state:
     st.session_state.whisper_params = get_whisper_settings()
 
+if "media_manager" not in st.session_state:
+    st.session_state.media_manager = MediaManager()
+
 # Whisper config
 # --------------
 st.write("### ⚙️ Whisper Settings")
@@ -20,6 +25,13 @@ with st.form("whisper_settings_form"):
     model_options = ["tiny", "base", "small", "medium", "large"]
     selected_model = model_options.index(st.session_state.whisper_params["whisper_model"])
     whisper_model = st.selectbox("Model", options=model_options, index=selected_model)
+    backend_options = list(ASR_BACKENDS)
+    asr_backend = st.selectbox(
+        "Engine",
+        options=backend_options,
+        index=backend_options.index(st.session_state.whisper_params["asr_backend"]),
+        help="faster-whisper is a reimplementation of whisper that is several times faster on CPU",
+    )
     temperature = st.number_input(
         "Temperature", min_value=0.0, max_value=1.0, value=st.session_state.whisper_params["temperature"], step=0.1
     )
@@ -55,11 +67,43 @@ with st.form("whisper_settings_form"):
         "Condition on previous text", value=st.session_state.whisper_params["condition_on_previous_text"]
     )
     verbose = st.checkbox("Verbose", value=st.session_state.whisper_params["verbose"])
+    quantize = st.checkbox(
+        "Int8 quantization (CPU)",
+        value=st.session_state.whisper_params["quantize"],
+        help="Int8 weights are faster & use less memory on CPU, but can be slightly less accurate",
+    )
+    vad_filter = st.checkbox(
+        "Skip silence",
+        value=st.session_state.whisper_params["vad_filter"],
+        help="Leave long silences out of transcription, which saves time on recordings with many pauses",
+    )
     task_options = ["transcribe", "translate"]
     task = st.selectbox(
         "Default mode", options=task_options, index=task_options.index(st.session_state.whisper_params["task"])
     )
 
+    st.write("#### Long files")
+    long_file_threshold = st.number_input(
+        "Split files longer than (seconds)",
+        min_value=0.0,
+        value=float(st.session_state.whisper_params["long_file_threshold"]),
+        step=60.0,
+        help="Long files are split at pauses & transcribed in parallel processes. Set to 0 to disable.",
+    )
+    chunk_length = st.number_input(
+        "Chunk length (seconds)", min_value=30.0, value=float(st.session_state.whisper_params["chunk_length"]), step=30.0
+    )
+    chunk_overlap = st.number_input(
+        "Chunk overlap (seconds)",
+        min_value=0.0,
+        max_value=60.0,
+        value=float(st.session_state.whisper_params["chunk_overlap"]),
+        step=1.0,
+    )
+    chunk_workers = st.number_input(
+        "Parallel chunk processes", min_value=1, value=int(st.session_state.whisper_params["chunk_workers"]), step=1
+    )
+
     save_settings = st.form_submit_button(label="💾 Save settings")
     success_container = st.empty()
 
@@ -74,7 +118,14 @@ with st.form("whisper_settings_form"):
             "compression_ratio_threshold": compression_ratio_threshold,
             "condition_on_previous_text": condition_on_previous_text,
             "verbose": verbose,
+            "quantize": quantize,
+            "asr_backend": asr_backend,
+            "vad_filter": vad_filter,
             "task": task,
+            "long_file_threshold": long_file_threshold,
+            "chunk_length": chunk_length,
+            "chunk_overlap": chunk_overlap,
+            "chunk_workers": chunk_workers,
         }
         # Commit to session & disk
         st.session_state.whisper_params = updated_whisper_settings
@@ -82,3 +133,57 @@ with st.form("whisper_settings_form"):
         success_container.success("Settings saved!")
 
 st.write(f"These settings are used for all media and will be saved to `{WHISPER_SETTINGS_FILE}`.")
+
+
+# Transcription metrics
+# ---------------------
+st.write("### 📈 Transcription Metrics")
+transcription_stats = st.session_state.media_manager.get_transcription_stats()
+if transcription_stats:
+    st.dataframe(
+        [
+            {
+                "Engine": stats["asr_backend"],
+                "Model": stats["whisper_model"],
+                "Transcriptions": stats["transcriptions"],
+                "Audio (hours)": round(stats["audio_hours"], 2),
+                "Wall time (hours)": round(stats["wall_hours"], 2),
+                "Mean real-time factor": round(stats["mean_real_time_factor"] or 0.0, 3),
+                "Audio hours per core hour": round(stats["audio_hours_per_core_hour"] or 0.0, 3),
+                "Max peak memory (MB)": round(stats["max_peak_rss_mb"] or 0.0),
+                "Fallbacks": stats["fallbacks"],
+                "Silence skipped (%)": round(100 * stats["skipped_fraction"], 1),
+            }
+            for stats in transcription_stats
+        ]
+    )
+    st.caption(
+        "The real-time factor is the transcription time divided by the audio length (below 1 is faster than real "
+        "time). Audio hours per core hour divide the hours of audio by the hours of CPU threads used by whisper."
+    )
+else:
+    st.write("No transcriptions recorded yet. Metrics are recorded by `python app/worker.py` for each transcription.")
+
+# Storage
+# -------
+st.write("### 💽 Storage")
+storage_stats = st.session_state.media_manager.get_storage_stats()
+if storage_stats["media"]:
+    original_col, stored_col = st.columns(2)
+    original_col.metric("Downloaded (MB)", round(storage_stats["original_size"] / 2**20, 1))
+    stored_col.metric(
+        "Stored (MB)",
+        round(storage_stats["stored_size"] / 2**20, 1),
+        delta=(
+            f"""{storage_stats["stored_size"] / storage_stats["original_size"] - 1:.0%}"""
+            if storage_stats["original_size"]
+            else None
+        ),
+        delta_color="inverse",
+    )
+    st.caption(
+        f"""Over {storage_stats["media"]} media item(s). Set `STORAGE_POLICY = "opus"` in `app/config.py` to store """
+        "only the audio of new media, transcoded to Opus."
+    )
+else:
+    st.write("No media sizes recorded yet. Sizes are recorded when media is downloaded.")
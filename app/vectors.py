@@ -0,0 +1,133 @@
+"""Semantic search over transcript segments using sentence embeddings & a FAISS index"""
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import faiss
+import numpy as np
+from config import EMBEDDING_MODEL, VECTOR_DIR
+
+
+@lru_cache(maxsize=1)
+def get_embedding_model(embedding_model: str):
+    "Get a sentence embedding model from the cache or download it if it doesn't exist"
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(embedding_model, device="cpu")
+
+
+def embed(texts: List[str]) -> np.ndarray:
+    "Unit length embeddings of the texts (so that inner product is cosine similarity)"
+    model = get_embedding_model(EMBEDDING_MODEL)
+    vectors = model.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+    return vectors.astype(np.float32)
+
+
+class SegmentIndex:
+    """FAISS index over segment embeddings, persisted as one vector file per transcript
+
+    Vector files are written once when a media object is transcribed & removed when it is deleted. Each process
+    keeps an in-memory index that it syncs with the vector directory before searching, adding the files it hasn't
+    seen yet & removing the ones that are gone, so the index grows & shrinks incrementally and is never rebuilt
+    (or re-embedded) as a whole.
+
+    The segments of all the transcripts of a media object are indexed, so callers drop those of inactive transcripts
+    from the results.
+    """
+
+    def __init__(self, vector_dir: Path):
+        self.vector_dir = vector_dir
+        self.vector_dir.mkdir(exist_ok=True, parents=True)
+        self.lock = threading.Lock()
+        self.index = None
+        # FAISS ids of each loaded vector file & the segment id of each FAISS id
+        self.file_ids: Dict[str, np.ndarray] = {}
+        self.segment_ids: Dict[int, str] = {}
+        self.next_id = 0
+
+    def _path(self, name: str) -> Path:
+        return self.vector_dir / f"{name}.npz"
+
+    def _save(self, name: str, segment_ids: List[str], vectors: np.ndarray):
+        # Write to a temporary file first so that other processes never load a partially written file
+        tmp_path = self.vector_dir / f".{name}.tmp.npz"
+        np.savez(tmp_path, segment_ids=np.array(segment_ids), vectors=vectors)
+        os.replace(tmp_path, self._path(name))
+
+    def add(self, media_id: str, transcript_id: str, segment_ids: List[str], texts: List[str]):
+        "Embed the segments of a transcript & persist their vectors"
+        if not segment_ids:
+            return
+        self._save(f"{media_id}.{transcript_id}", segment_ids, embed(texts))
+
+    def copy(
+        self,
+        media_id: str,
+        transcript_id: str,
+        segment_ids: List[str],
+        source_media_id: str,
+        source_transcript_id: str,
+        source_segment_ids: List[str],
+    ) -> bool:
+        """Persist the vectors of the segments of another transcript for copies of them (in the same order), without
+        embedding them again, & return whether the vectors of the other transcript were found
+        """
+        if not segment_ids:
+            return True
+        # NOTE: Vector files written before media objects could have several transcripts are named by media id only &
+        # hold the vectors of its first transcript, which may not be this one
+        for name in (f"{source_media_id}.{source_transcript_id}", source_media_id):
+            try:
+                data = np.load(self._path(name))
+            except FileNotFoundError:
+                continue
+            if data["segment_ids"].tolist() == source_segment_ids:
+                self._save(f"{media_id}.{transcript_id}", segment_ids, data["vectors"])
+                return True
+        return False
+
+    def remove(self, media_id: str):
+        "Drop the vectors of all the transcripts of a deleted media object"
+        # NOTE: Vector files written before media objects could have several transcripts are named by media id only
+        for path in [self._path(media_id), *self.vector_dir.glob(f"{media_id}.*.npz")]:
+            path.unlink(missing_ok=True)
+
+    def sync(self):
+        "Load vector files added since the last sync & unload the ones that were removed"
+        with self.lock:
+            on_disk = {path.stem for path in self.vector_dir.glob("*.npz") if not path.name.startswith(".")}
+
+            for name in set(self.file_ids) - on_disk:
+                ids = self.file_ids.pop(name)
+                self.index.remove_ids(ids)
+                for faiss_id in ids:
+                    del self.segment_ids[int(faiss_id)]
+
+            for name in on_disk - set(self.file_ids):
+                try:
+                    data = np.load(self._path(name))
+                except FileNotFoundError:
+                    # Deleted since the directory was listed
+                    continue
+                vectors = data["vectors"]
+                if self.index is None:
+                    self.index = faiss.IndexIDMap(faiss.IndexFlatIP(vectors.shape[1]))
+                ids = np.arange(self.next_id, self.next_id + len(vectors), dtype=np.int64)
+                self.next_id += len(vectors)
+                self.index.add_with_ids(vectors, ids)
+                self.file_ids[name] = ids
+                self.segment_ids.update(zip(ids.tolist(), data["segment_ids"].tolist()))
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        "Ids & cosine similarity of the (up to) k segments closest in meaning to the query"
+        self.sync()
+        if self.index is None or self.index.ntotal == 0:
+            return []
+        with self.lock:
+            scores, ids = self.index.search(embed([query]), min(k, self.index.ntotal))
+            return [(self.segment_ids[int(i)], float(score)) for i, score in zip(ids[0], scores[0]) if i != -1]
+
+
+SEGMENT_INDEX = SegmentIndex(VECTOR_DIR)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Background worker that downloads & transcribes media queued from the Whisper page.
+
+Run one or more of these alongside the Streamlit app:
+
+    python app/worker.py --download-threads 4 --transcribe-processes 2
+
+Downloads are network bound and run on a thread pool, while whisper inference is CPU bound and runs on a
+(bounded) process pool. Downloaded media waits in between, so the next item downloads while the current one is
+being transcribed and a playlist is limited by transcription throughput rather than downloads + transcription.
+
+Short clips (e.g. voice notes) are transcribed in batches, which makes better use of the CPU than one at a time.
+Transcripts are saved as they are decoded. Jobs of a worker that was killed are put back on the queue when a worker
+starts on the same host & continue from where they were interrupted.
+
+Run `python app/worker.py --vacuum` now & then (e.g. after deleting a lot of media) to compact the database.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List
+
+from config import WHISPER_PRELOAD_MODELS
+from core import (
+    BATCH_MAX_DURATION,
+    MediaManager,
+    download_source,
+    init_transcriber,
+    start_trash_collector,
+    timed,
+    transcribe_job,
+    transcribe_job_batch,
+)
+from db import ENGINE, vacuum
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(
+    poll_interval: float,
+    download_threads: int,
+    transcribe_processes: int,
+    preload_models: List[str],
+    batch_size: int = 1,
+):
+    "Process jobs from the queue until interrupted"
+    media_manager = MediaManager()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info("Worker %s started", worker)
+    # Resume the jobs of workers on this host that were killed (e.g. by a restart) from their last checkpoint
+    for job_id in media_manager.requeue_interrupted_jobs(socket.gethostname()):
+        logger.info("Requeued interrupted job %s", job_id)
+    # Remove the files of deleted media in the background
+    start_trash_collector()
+
+    # Bound the number of downloaded files waiting for a transcriber so that the queue between the stages
+    # doesn't fill up the disk when downloads are faster than transcription
+    max_in_flight = download_threads + 2 * transcribe_processes + batch_size
+    downloads = {}
+    # The jobs transcribed by each future (several when short clips are transcribed in a batch)
+    transcriptions = {}
+    # Downloaded short clips waiting to fill a batch, by job settings (only clips with the same settings are batched)
+    short_jobs = {}
+
+    def in_flight() -> int:
+        waiting = [*transcriptions.values(), *short_jobs.values()]
+        return len(downloads) + sum(len(job_ids) for job_ids in waiting)
+
+    def transcribe(job_id: str):
+        "Transcribe a downloaded job, or hold it back for a batch if it's a short clip"
+        media_obj = media_manager.get_job_media(job_id)
+        job = media_manager.get_job(job_id)
+        # Jobs that were interrupted continue where they were, on their own
+        if batch_size > 1 and not job.checkpoint and (media_obj.duration or float("inf")) <= BATCH_MAX_DURATION:
+            short_jobs.setdefault(job.settings, []).append(job_id)
+        else:
+            transcriptions[submit_transcription(transcribe_job, job_id)] = [job_id]
+
+    def submit_batches():
+        "Transcribe the short clips that fill a batch, or all of them when no more are being downloaded"
+        for settings, job_ids in list(short_jobs.items()):
+            while len(job_ids) >= batch_size or (job_ids and not downloads):
+                batch, job_ids[:] = job_ids[:batch_size], job_ids[batch_size:]
+                transcriptions[submit_transcription(transcribe_job_batch, batch)] = batch
+            if not job_ids:
+                del short_jobs[settings]
+
+    def start_transcribe_pool() -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(
+            max_workers=transcribe_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_transcriber,
+            initargs=(max(1, os.cpu_count() // transcribe_processes), tuple(preload_models)),
+        )
+        # Start all transcription processes right away (rather than on demand) so that models are preloaded before
+        # the first job arrives
+        wait([pool.submit(time.sleep, 0) for _ in range(transcribe_processes)])
+        return pool
+
+    def submit_transcription(fn, *args):
+        """Run a transcription function in the process pool, starting a new pool if a process of the current one died
+        (e.g. killed when out of memory)
+
+        The jobs that were being transcribed by the pool that broke fail when their results are read.
+        """
+        nonlocal transcribe_pool
+        try:
+            return transcribe_pool.submit(timed, fn, *args)
+        except BrokenProcessPool:
+            logger.warning("A transcription process died, restarting the transcription processes")
+            transcribe_pool = start_transcribe_pool()
+            return transcribe_pool.submit(timed, fn, *args)
+
+    transcribe_pool = start_transcribe_pool()
+    with ThreadPoolExecutor(max_workers=download_threads) as download_pool:
+        try:
+            while True:
+                # Claim new jobs while there is room in the pipeline
+                while in_flight() < max_in_flight:
+                    job_id = media_manager.claim_job(worker)
+                    if job_id is None:
+                        break
+
+                    logger.info("Processing job %s", job_id)
+                    job = media_manager.get_job(job_id)
+                    media_obj = media_manager.get_job_media(job_id)
+                    # Retried & re-transcription jobs have been downloaded already
+                    if media_obj is not None:
+                        try:
+                            # Reuse the transcript of identical audio if there is one
+                            if media_manager.reuse_job_transcript(job_id):
+                                logger.info("Reused existing transcript for job %s", job_id)
+                                continue
+                            transcribe(job_id)
+                        except Exception:
+                            logger.exception("Job %s failed to start transcribing", job_id)
+                            media_manager.finish_job(job_id, error=traceback.format_exc())
+                    else:
+                        future = download_pool.submit(
+                            timed,
+                            download_source,
+                            job.source_type,
+                            job.source,
+                            job.source_name,
+                            job.audio_hash,
+                            media_manager.media_dir,
+                        )
+                        downloads[future] = job_id
+
+                submit_batches()
+
+                # Wait for new jobs if the queue is empty
+                if not downloads and not transcriptions:
+                    time.sleep(poll_interval)
+                    continue
+
+                # Move finished downloads on to transcription & save finished transcriptions
+                done, _ = wait([*downloads, *transcriptions], timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in downloads:
+                        job_id = downloads.pop(future)
+                        try:
+                            (source_name, filepath, audio_hash, original_size), download_time = future.result()
+                            media_manager.create_job_media(
+                                job_id, source_name, filepath, audio_hash, download_time, original_size
+                            )
+                            logger.info("Downloaded job %s in %.1fs", job_id, download_time)
+                            # Reuse the transcript of identical audio if there is one
+                            if media_manager.reuse_job_transcript(job_id):
+                                logger.info("Reused existing transcript for job %s", job_id)
+                                continue
+                            transcribe(job_id)
+                        except Exception:
+                            logger.exception("Job %s failed to download", job_id)
+                            media_manager.finish_job(job_id, error=traceback.format_exc())
+                    else:
+                        job_ids = transcriptions.pop(future)
+                        try:
+                            resources, transcribe_time = future.result()
+                        # This includes the jobs of a transcription process that died (see `submit_transcription`)
+                        except Exception:
+                            logger.exception("Jobs %s failed to transcribe", ", ".join(job_ids))
+                            error = traceback.format_exc()
+                            for job_id in job_ids:
+                                media_manager.finish_job(job_id, error=error)
+                            continue
+                        for job_id in job_ids:
+                            try:
+                                # The clips of a batch are transcribed together, so they share its time equally
+                                media_manager.complete_job_transcript(
+                                    job_id, transcribe_time / len(job_ids), resources
+                                )
+                                job = media_manager.get_job(job_id)
+                                logger.info(
+                                    "Finished job %s (download %.1fs, transcribe %.1fs, save %.1fs, "
+                                    "silence skipped %.1fs)",
+                                    job_id,
+                                    job.download_time or 0.0,
+                                    job.transcribe_time,
+                                    job.save_time,
+                                    job.skipped_duration or 0.0,
+                                )
+                            except Exception:
+                                logger.exception("Job %s failed to save", job_id)
+                                media_manager.finish_job(job_id, error=traceback.format_exc())
+        finally:
+            transcribe_pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process queued media transcription jobs")
+    parser.add_argument("--download-threads", type=int, default=4, help="Number of concurrent downloads")
+    parser.add_argument(
+        "--transcribe-processes", type=int, default=1, help="Number of processes running whisper concurrently"
+    )
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        default=WHISPER_PRELOAD_MODELS,
+        help="Whisper models to load & warm up in each transcription process at start",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="Number of short clips (up to 30 seconds) transcribed together in one batch, 1 to disable batching",
+    )
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait when the queue is empty")
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="Compact the database & rebuild its full-text indexes, then exit (best run while no worker is busy)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+    if args.vacuum:
+        _, duration = timed(vacuum, ENGINE)
+        logger.info("Vacuumed the database in %.1fs", duration)
+        return
+
+    run_worker(args.poll_interval, args.download_threads, args.transcribe_processes, args.preload, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""End to end benchmark of the media pipeline: stage an upload, transcribe it as a worker would & export it.
+
+    python benchmarks/bench_ingest.py --lengths 60 600 --transcribers stub tiny
+
+Audio is synthetic (tone bursts separated by pauses) so that runs are reproducible & offline. The `stub` transcriber
+returns a segment every few seconds without running a model, which measures the pipeline overhead (decoding, database
+writes, indexing & exports). Whisper models (e.g. `tiny`) measure real inference & need to be downloaded once.
+
+Each run uses a fresh data directory & process, and reports the time spent in each stage, the throughput (seconds of
+audio per second) & the peak memory as JSON.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+APP_DIR = Path(__file__).parent.parent / "app"
+
+
+def synthetic_audio(seconds: float, seed: int = 0) -> bytes:
+    "A 16 kHz mono wav file of tone bursts of 1-8 seconds separated by pauses of 0.3-2 seconds"
+    rng = np.random.default_rng(seed)
+    parts = []
+    n_samples = 0
+    while n_samples < seconds * SAMPLE_RATE:
+        burst = np.arange(int(rng.uniform(1.0, 8.0) * SAMPLE_RATE)) / SAMPLE_RATE
+        frequencies = rng.uniform(120.0, 800.0, size=3)
+        tone = sum(np.sin(2 * np.pi * frequency * burst) for frequency in frequencies) / len(frequencies)
+        # Syllable-like amplitude modulation
+        tone *= 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(3.0, 6.0) * burst))
+        pause = np.zeros(int(rng.uniform(0.3, 2.0) * SAMPLE_RATE))
+        parts.extend([0.3 * tone, pause])
+        n_samples += len(burst) + len(pause)
+    audio = np.concatenate(parts)[: int(seconds * SAMPLE_RATE)]
+    audio += rng.normal(0.0, 0.005, size=len(audio))
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+class StubModel:
+    "Stands in for a whisper model: returns a segment every `segment_length` seconds of audio without inference"
+
+    def __init__(self, segment_length: float = 5.0):
+        self.segment_length = segment_length
+
+    def transcribe(self, audio, **whisper_args) -> dict:
+        duration = len(audio) / SAMPLE_RATE
+        segments = [
+            {
+                "id": i,
+                "seek": int(start * 100),
+                "start": start,
+                "end": min(duration, start + self.segment_length),
+                "text": f" Synthetic segment number {i} of the benchmark audio.",
+                "temperature": 0.0,
+                "avg_logprob": -0.25,
+                "compression_ratio": 1.4,
+                "no_speech_prob": 0.01,
+            }
+            for i, start in enumerate(np.arange(0.0, duration, self.segment_length).tolist())
+        ]
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments, "language": "en"}
+
+
+def run(seconds: float, transcriber: str, skip_index: bool) -> dict:
+    "Ingest a synthetic file of the given length in a fresh data directory (runs in its own process)"
+    data_dir = tempfile.mkdtemp(prefix="bench-ingest-")
+    # The data directory is read when the app modules are imported
+    os.environ["BABYJARVIS_DATA_DIR"] = data_dir
+    sys.path.insert(0, str(APP_DIR))
+
+    import core
+    from audio import load_audio
+    from config import WHISPER_DEFAULT_SETTINGS
+
+    media_manager = core.MediaManager()
+    if transcriber == "stub":
+        core.MODEL_POOL.models[("whisper", "stub", core.MODEL_POOL.default_device(), False)] = (StubModel(), 0)
+    if skip_index:
+        core.SEGMENT_INDEX.add = lambda *args, **kwargs: None
+
+    # Time the database writes made while transcribing, which are interleaved with inference
+    db_write_time = 0.0
+    save_job_window = core.MediaManager.save_job_window
+
+    def timed_save_job_window(self, *args, **kwargs):
+        nonlocal db_write_time
+        start = time.perf_counter()
+        save_job_window(self, *args, **kwargs)
+        db_write_time += time.perf_counter() - start
+
+    core.MediaManager.save_job_window = timed_save_job_window
+
+    # Time the embedding of the segments, which runs at the end of the transcription
+    index_time = 0.0
+    index_job_transcript = core.MediaManager.index_job_transcript
+
+    def timed_index_job_transcript(self, *args, **kwargs):
+        nonlocal index_time
+        start = time.perf_counter()
+        index_job_transcript(self, *args, **kwargs)
+        index_time += time.perf_counter() - start
+
+    core.MediaManager.index_job_transcript = timed_index_job_transcript
+
+    upload = io.BytesIO(synthetic_audio(seconds))
+    upload.name = "benchmark.wav"
+    # Chunk processes of the long file mode wouldn't have the stub, so transcribe sequentially
+    settings = {**WHISPER_DEFAULT_SETTINGS, "whisper_model": transcriber, "long_file_threshold": None}
+    timings = {}
+    total_start = time.perf_counter()
+
+    # Save & hash the upload & queue it
+    (job_id,), timings["stage"] = core.timed(media_manager.add, upload, "upload", **settings)
+    # Claim the job & record the media (probing its duration)
+    start = time.perf_counter()
+    assert media_manager.claim_job("benchmark") == job_id
+    job = media_manager.get_job(job_id)
+    source_name, filepath, audio_hash, original_size = core.download_source(
+        job.source_type, job.source, job.source_name, job.audio_hash, media_manager.media_dir
+    )
+    media_obj = media_manager.create_job_media(job_id, source_name, filepath, audio_hash, 0.0, original_size)
+    timings["ingest"] = time.perf_counter() - start
+    # Decode to 16 kHz (& cache it, so that transcription doesn't decode again)
+    _, timings["decode"] = core.timed(load_audio, media_obj.filepath)
+    # Transcribe window by window, saving each window
+    resources, transcribe_time = core.timed(core.transcribe_job, job_id)
+    timings["inference"] = transcribe_time - db_write_time - index_time
+    timings["db_write"] = db_write_time
+    timings["index"] = index_time
+    # Make the transcript active
+    media_manager.complete_job_transcript(job_id, transcribe_time, resources)
+    timings["finalize"] = media_manager.get_job(job_id).save_time
+    # Export every format
+    transcript_id = media_manager.get_job(job_id).transcript_id
+    start = time.perf_counter()
+    for output_format in core.EXPORT_FORMATS:
+        media_manager.export_transcript(transcript_id, output_format)
+    timings["export"] = time.perf_counter() - start
+
+    total_time = time.perf_counter() - total_start
+    result = {
+        "transcriber": transcriber,
+        "audio_seconds": seconds,
+        "segments": len(media_manager.get_detail(media_manager.get_job(job_id).media_id)["segments"]),
+        "stage_seconds": timings,
+        "total_seconds": total_time,
+        "audio_seconds_per_second": seconds / total_time,
+        "peak_rss_mb": core.peak_rss_mb(),
+    }
+    shutil.rmtree(data_dir)
+    return result
+
+
+def run_in_process(seconds: float, transcriber: str, skip_index: bool) -> dict:
+    "Run in a new process so that the peak memory & the data directory are those of this run only"
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run, (seconds, transcriber, skip_index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", type=float, nargs="+", default=[60.0, 600.0], help="Audio lengths in seconds")
+    parser.add_argument(
+        "--transcribers", nargs="+", default=["stub", "tiny"], help="`stub` and/or whisper model names"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per length & transcriber (the fastest is reported)")
+    parser.add_argument(
+        "--skip-index", action="store_true", help="Don't embed segments for semantic search (e.g. when offline)"
+    )
+    args = parser.parse_args()
+
+    results = []
+    for transcriber in args.transcribers:
+        for seconds in args.lengths:
+            runs = [run_in_process(seconds, transcriber, args.skip_index) for _ in range(args.repeat)]
+            results.append(min(runs, key=lambda result: result["total_seconds"]))
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Compare int8 quantized whisper models with full precision ones on CPU: speed, memory & accuracy.
+
+    python benchmarks/bench_quantization.py --audio clip.wav --models tiny base
+
+Each model is loaded & run on the same local clip in full precision & quantized (see `quantize_model` in asr.py),
+each in its own process. Accuracy is the word error rate of the quantized transcript against the full precision one,
+or against a reference transcript given with `--reference`. Results are printed as JSON.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+APP_DIR = Path(__file__).parent.parent / "app"
+
+
+def words(text: str) -> List[str]:
+    "Lowercase words of the text, without punctuation"
+    return re.findall(r"[\w']+", text.lower())
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    "Word level edit distance between the transcripts, relative to the number of words of the reference"
+    reference_words, hypothesis_words = words(reference), words(hypothesis)
+    distances = list(range(len(hypothesis_words) + 1))
+    for i, reference_word in enumerate(reference_words, 1):
+        previous, distances[0] = distances[0], i
+        for j, hypothesis_word in enumerate(hypothesis_words, 1):
+            previous, distances[j] = distances[j], min(
+                distances[j] + 1, distances[j - 1] + 1, previous + (reference_word != hypothesis_word)
+            )
+    return distances[-1] / max(1, len(reference_words))
+
+
+def run(audio_path: str, whisper_model: str, quantize: bool, repeat: int) -> dict:
+    "Load the model & transcribe the clip (runs in its own process)"
+    sys.path.insert(0, str(APP_DIR))
+
+    import whisper
+    from core import MODEL_POOL, peak_rss_mb, timed
+
+    # Decode without the cache of the app, which would write to its data directory
+    audio = whisper.load_audio(audio_path)
+    transcriber, load_time = timed(MODEL_POOL.get, whisper_model, "cpu", quantize)
+
+    runs = [timed(transcriber.transcribe, audio, temperature=0.0) for _ in range(repeat)]
+    transcript, transcribe_time = min(runs, key=lambda run: run[1])
+    return {
+        "whisper_model": whisper_model,
+        "precision": "int8" if quantize else "fp32",
+        "load_seconds": load_time,
+        "transcribe_seconds": transcribe_time,
+        "real_time_factor": transcribe_time / (len(audio) / whisper.audio.SAMPLE_RATE),
+        # As accounted for by the model pool's memory budget
+        "weights_mb": transcriber.backend.model_size(transcriber.model) / 2**20,
+        "peak_rss_mb": peak_rss_mb(),
+        "text": transcript["text"],
+    }
+
+
+def run_in_process(audio_path: str, whisper_model: str, quantize: bool, repeat: int) -> dict:
+    "Run in a new process so that the peak memory is that of this model only"
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run, (audio_path, whisper_model, quantize, repeat))
+
+
+def compare(audio_path: str, whisper_model: str, repeat: int, reference: Optional[str]) -> List[dict]:
+    "Full precision & quantized results of a model, with the word error rate of each"
+    results = [run_in_process(audio_path, whisper_model, quantize, repeat) for quantize in (False, True)]
+    reference = reference if reference is not None else results[0]["text"]
+    for result in results:
+        result["word_error_rate"] = word_error_rate(reference, result["text"])
+    results[1]["speedup"] = results[0]["transcribe_seconds"] / results[1]["transcribe_seconds"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--audio", required=True, help="Audio or video file to transcribe")
+    parser.add_argument("--models", nargs="+", default=["tiny", "base"], help="Whisper model names")
+    parser.add_argument("--repeat", type=int, default=3, help="Transcriptions per model (the fastest is reported)")
+    parser.add_argument(
+        "--reference", help="Text file with the correct transcript (defaults to the full precision transcript)"
+    )
+    args = parser.parse_args()
+
+    reference = Path(args.reference).read_text() if args.reference else None
+    # The data directory is read when the app modules are imported (in each process): use a temporary one rather than
+    # the app's
+    data_dir = tempfile.mkdtemp(prefix="bench-quantization-")
+    os.environ["BABYJARVIS_DATA_DIR"] = data_dir
+    try:
+        results = []
+        for whisper_model in args.models:
+            results.extend(compare(args.audio, whisper_model, args.repeat, reference))
+    finally:
+        shutil.rmtree(data_dir)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Check that listings & details cost a constant number of SQL statements, however many rows they return.
+
+    python benchmarks/bench_query_count.py --media 150
+
+Fills a fresh data directory with synthetic media & transcripts (no audio or models needed), counts the statements of
+each read with `db.QueryCounter` at 10 & at 100 rows, and prints the counts as JSON. Exits with an error if any read
+issues more statements for 100 rows than for 10 (e.g. a query per row).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+APP_DIR = Path(__file__).parent.parent / "app"
+
+
+def make_transcript(n_segments: int, word: str) -> dict:
+    "A synthetic whisper transcript with `n_segments` segments that all contain `word`"
+    segments = [
+        {
+            "id": i,
+            "text": f" Segment number {i} says {word}.",
+            "start": i * 2.0,
+            "end": i * 2.0 + 2.0,
+            "temperature": 0.0,
+            "avg_logprob": -0.25,
+            "compression_ratio": 1.4,
+            "no_speech_prob": 0.01,
+        }
+        for i in range(n_segments)
+    ]
+    return {"text": "".join(segment["text"] for segment in segments), "language": "en", "segments": segments}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--media", type=int, default=150, help="Number of media objects (at least 100)")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench-query-count-")
+    # The data directory is read when the app modules are imported
+    os.environ["BABYJARVIS_DATA_DIR"] = data_dir
+    sys.path.insert(0, str(APP_DIR))
+
+    from core import MediaManager
+    from db import Media, QueryCounter
+
+    media_manager = MediaManager()
+    media_ids = []
+    for i in range(args.media):
+        media_obj = Media(source_type="upload", source_name=f"media {i}", filepath=f"{data_dir}/audio-{i}.wav")
+        media_manager.session.add(media_obj)
+        media_manager.session.flush()
+        # The first two media objects are read in detail views of 100 & 10 segments
+        n_segments = {0: 100, 1: 10}.get(i, 2)
+        transcript = make_transcript(n_segments, "hello")
+        transcript_obj = media_manager._new_transcript(
+            media_obj.id, "base", {}, text=transcript["text"], language=transcript["language"]
+        )
+        media_manager._activate_transcript(transcript_obj)
+        media_manager._insert_segments(transcript_obj, transcript["segments"])
+        media_manager.session.commit()
+        media_ids.append(media_obj.id)
+
+    reads = {
+        "get_list": lambda n: media_manager.get_list(limit=n),
+        "get_list (search)": lambda n: media_manager.get_list(limit=n, search_by_transcript="hello"),
+        "get_segments": lambda n: media_manager.get_segments(limit=n),
+        "get_segments (search)": lambda n: media_manager.get_segments(limit=n, search_by_transcript="hello"),
+        "get_detail": lambda n: media_manager.get_detail(media_ids[0 if n == 100 else 1]),
+    }
+    results = []
+    for name, read in reads.items():
+        counts = {}
+        for n in (10, 100):
+            with QueryCounter() as counter:
+                read(n)
+            counts[n] = counter.count
+        results.append({"read": name, "statements_10": counts[10], "statements_100": counts[100]})
+    media_manager.session.close()
+    shutil.rmtree(data_dir)
+
+    print(json.dumps(results, indent=4))
+    growing = [result["read"] for result in results if result["statements_100"] > result["statements_10"]]
+    if growing:
+        sys.exit(f"Statements grow with the number of rows for: {', '.join(growing)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Micro-benchmark of saving a transcript's segments: one ORM object per segment vs. a single executemany insert.
+
+    python benchmarks/bench_segment_insert.py --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# The data directory is read when the app modules are imported: use a temporary one rather than the app's
+DATA_DIR = tempfile.mkdtemp(prefix="bench-segment-insert-")
+os.environ["BABYJARVIS_DATA_DIR"] = DATA_DIR
+# The app modules are imported as top level modules (as when running streamlit from the app directory)
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+
+from core import MediaManager  # noqa: E402
+from db import Base, Media, Segment, Transcript  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+
+def make_transcript(n_segments: int) -> dict:
+    "A synthetic whisper transcript with `n_segments` segments"
+    segments = [
+        {
+            "id": i,
+            "text": f" This is the text of segment number {i} of the synthetic transcript.",
+            "start": i * 2.0,
+            "end": i * 2.0 + 2.0,
+            "temperature": 0.0,
+            "avg_logprob": -0.25,
+            "compression_ratio": 1.4,
+            "no_speech_prob": 0.01,
+        }
+        for i in range(n_segments)
+    ]
+    return {"text": "".join(segment["text"] for segment in segments), "language": "en", "segments": segments}
+
+
+def insert_per_object(session: Session, media_obj: Media, transcript: dict, whisper_model: str):
+    "The previous save path: one ORM object per segment"
+    session.add(
+        Transcript(
+            media_id=media_obj.id,
+            media=media_obj,
+            text=transcript["text"],
+            language=transcript["language"],
+            generated_by=f"whisper-{whisper_model}",
+        )
+    )
+    for segment in transcript["segments"]:
+        session.add(
+            Segment(
+                media_id=media_obj.id,
+                media=media_obj,
+                number=segment["id"],
+                text=segment["text"],
+                start=segment["start"],
+                end=segment["end"],
+                generated_by=f"whisper-{whisper_model}",
+                temperature=segment["temperature"],
+                avg_logprob=segment["avg_logprob"],
+                compression_ratio=segment["compression_ratio"],
+                no_speech_prob=segment["no_speech_prob"],
+            )
+        )
+    session.commit()
+
+
+def insert_bulk(media_manager: MediaManager, media_obj: Media, transcript: dict, whisper_model: str):
+    "The current save path, as used by the worker: a single executemany insert of all the segments"
+    transcript_obj = media_manager._new_transcript(
+        media_obj.id, whisper_model, {}, text=transcript["text"], language=transcript["language"]
+    )
+    media_manager._activate_transcript(transcript_obj)
+    media_manager._insert_segments(transcript_obj, transcript["segments"])
+    media_manager.session.commit()
+
+
+def run(n_segments: int, repeat: int) -> dict:
+    transcript = make_transcript(n_segments)
+    timings = {"per_object": [], "bulk": []}
+
+    for _ in range(repeat):
+        for method in timings:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                # Use a fresh on-disk database for every run so that runs don't affect each other
+                engine = create_engine(f"sqlite:///{tmp_dir}/bench.sqlite3")
+                Base.metadata.create_all(engine)
+                media_manager = MediaManager(media_dir=Path(tmp_dir) / "media")
+                media_manager.session = Session(engine)
+                media_obj = Media(source_type="upload", source_name="bench", filepath=f"{tmp_dir}/audio.wav")
+                media_manager.session.add(media_obj)
+                media_manager.session.commit()
+
+                start = time.perf_counter()
+                if method == "per_object":
+                    insert_per_object(media_manager.session, media_obj, transcript, "base")
+                else:
+                    insert_bulk(media_manager, media_obj, transcript, "base")
+                timings[method].append(time.perf_counter() - start)
+
+                media_manager.session.close()
+                engine.dispose()
+
+    result = {"segments": n_segments}
+    for method, values in timings.items():
+        result[f"{method}_seconds"] = min(values)
+    result["speedup"] = result["per_object_seconds"] / result["bulk_seconds"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size & method (the fastest is reported)")
+    args = parser.parse_args()
+
+    try:
+        results = [run(n_segments, args.repeat) for n_segments in args.sizes]
+    finally:
+        shutil.rmtree(DATA_DIR)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()